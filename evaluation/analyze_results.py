@@ -1,133 +1,325 @@
-import json
 import argparse
+import glob
+import json
+import os
+from collections import namedtuple
 
+import numpy as np
+
+from scoring import (Summary, flatten_judgements, question_failures,
+                     score_judgements, sequential_mean, summarize)
+from significance import bootstrap_many, paired_permutation_test, paired_scores
+from slicing import (JUDGE_MODELS, SLICE_COLUMNS, load_sample_attributes,
+                     parse_result_name, question_columns, slice_metrics,
+                     write_table)
+from score_cache import ScoreCache
+from streaming import stream_file
+
+# Per-question score arrays behind the STA_* means, in the order they are
+# stacked for the significance tests.
+METRICS = ("conc_scores", "proc_scores", "lcrs_scores")
+
+# What analyze_file keeps of a result file for the cross-file reports:
+# `matrix` stacks the METRICS per question, `keys` pairs questions across
+# files, `sample_ids` / `positions` join them with the dataset, `failures`
+# holds the per-question counts of scoring.question_failures.
+ScoredFile = namedtuple(
+    "ScoredFile",
+    ["static_results", "keys", "matrix", "sample_ids", "positions", "failures"])
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--file_path", type=str, default="eval_results/llm_judgements_open_basic_lingshu_deepseek-v3.2-ca_final_data.json")
-    args = parser.parse_args()
 
-    with open(args.file_path, 'r', encoding='utf-8') as file:
+def expand_paths(patterns):
+    # Result files in the order given; glob patterns are expanded (sorted).
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return list(dict.fromkeys(paths))
+
+
+def analyze_file(file_path, out_dir):
+    with open(file_path, 'r', encoding='utf-8') as file:
         results = json.load(file)
 
-    judgements = [data["judgement"] for data in results]
-
-    conclusion_scores = list()
-    conclusion_scores_sta = {
-        "0": 0,
-        "0.25": 0,
-        "0.5": 0,
-        "0.75": 0,
-        "1.0": 0
-    }
-
-    process_scores = list()
-    process_scores_sta = {
-        "0~0.25": 0,
-        "0.25~0.5": 0,
-        "0.5~0.75": 0,
-        "0.75~1": 0
-    }
-
-    process_failures = {
-        "visual": 0,
-        "interpretation": 0,
-        "conclusion": 0
-    }
-
-    num_exp = 0
-    error = dict()
-    print(args.file_path)
-    for i, jud in enumerate(judgements):
-        score_con = float(jud["conclusion_score"]) / 4
-
-        def find_index(num, ranges):
-            return next((k for k in ranges if float(k) == num), None)
-
-        index = find_index(score_con, conclusion_scores_sta)
-        if index:
-            conclusion_scores_sta[index] += 1
-        else:
-            error[f"Question[{i}]"] = f"Error conclusion score: {score_con}\n"
+    arrays = flatten_judgements([data["judgement"] for data in results])
+    scores = score_judgements(arrays)
 
-        exp_scores = []
-        for exp in jud["experiments"]:
-            num_exp += 1
-            exp_step = 3
+    static_results = summarize(arrays, scores)
+    static_results["conclusion_scores"] = scores.conc.tolist()
+    static_results["process_scores"] = scores.proc.tolist()
+    static_results['lcrs_scores'] = sequential_mean(scores.lcr)
+    static_results['proc_scores'] = sequential_mean(scores.proc)
+    static_results['conc_scores'] = sequential_mean(scores.conc)
 
-            vis = exp["visual_phenomenon"]
-            inte = exp["interpretation"]
-            con = exp["sub-conclusion"]
+    name = os.path.basename(file_path)
+    save_path = os.path.join(out_dir, f"STA_{name}")
+    with open(save_path, 'w', encoding='utf-8') as file:
+        json.dump(static_results, file, ensure_ascii=False, indent=2)
+    # save the updated results with scores
+    for data, score_con, score_pro in zip(results, scores.conc.tolist(),
+                                          scores.proc.tolist()):
+        data["conc_score"] = score_con
+        data["proc_score"] = score_pro
+    updated_results_path = os.path.join(out_dir, f"Updated_{name}")
+    with open(updated_results_path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    # Questions are matched across files by original_sample_index, else by
+    # question_index (the notebook's records only carry that one), and only
+    # as a last resort by their position in the file.
+    sample_ids = [data.get("original_sample_index") for data in results]
+    positions = [
+        data.get("question_index", i) for i, data in enumerate(results)
+    ]
+    keys = []
+    unkeyed = 0
+    for i, (oid, data) in enumerate(zip(sample_ids, results)):
+        if oid is not None:
+            keys.append(f"oid:{oid}")
+        elif data.get("question_index") is not None:
+            keys.append(f"qid:{data['question_index']}")
+        else:
+            keys.append(f"pos:{i}")
+            unkeyed += 1
+    if unkeyed:
+        print(f"Warning: {unkeyed} record(s) of {file_path} have neither "
+              f"original_sample_index nor question_index; they are paired "
+              f"by position, and only with records keyed the same way")
+    matrix = np.vstack([scores.conc, scores.proc, scores.lcr])
+    return ScoredFile(static_results, keys, matrix, sample_ids, positions,
+                      question_failures(arrays))
 
-            if vis == -1:
-                vis = 1
-                exp_step = 2
 
-            if vis == 0:
-                process_failures["visual"] += 1
+def significance(scored, args):
+    # Bootstrap CIs of every scored file and paired permutation tests of the
+    # --compare pairs; printed and written to significance.json.
+    report = {"bootstrap": {}, "paired": []}
+    if args.bootstrap:
+        names = list(scored)
+        intervals = bootstrap_many([scored[name].matrix for name in names],
+                                   args.bootstrap, args.alpha, args.seed,
+                                   args.workers)
+        print(f"\nBootstrap {1 - args.alpha:.0%} CIs "
+              f"({args.bootstrap} resamples)")
+        for name, ci in zip(names, intervals):
+            sta = scored[name].static_results
+            report["bootstrap"][name] = {
+                metric: [sta[metric], low, high]
+                for metric, (low, high) in zip(METRICS, ci.tolist())
+            }
+            print(f"{os.path.basename(name)}: " + ", ".join(
+                f"{metric} {sta[metric]:.4f} [{low:.4f}, {high:.4f}]"
+                for metric, (low, high) in zip(METRICS, ci.tolist())))
+    for i, (path_a, path_b) in enumerate(args.compare or []):
+        a, b = paired_scores(scored[path_a].keys, scored[path_a].matrix,
+                             scored[path_b].keys, scored[path_b].matrix)
+        if not a.shape[1]:
+            print(f"\nWarning: {os.path.basename(path_a)} and "
+                  f"{os.path.basename(path_b)} share no questions; skipped")
+            continue
+        observed, p_values = paired_permutation_test(
+            a, b, args.permutations, args.seed + i)
+        report["paired"].append({
+            "a": path_a,
+            "b": path_b,
+            "shared_questions": a.shape[1],
+            **{
+                metric: {
+                    "difference": diff,
+                    "p_value": p
+                }
+                for metric, diff, p in zip(METRICS, observed.tolist(),
+                                           p_values.tolist())
+            }
+        })
+        print(f"\n{os.path.basename(path_a)} - {os.path.basename(path_b)} "
+              f"({a.shape[1]} shared questions, {args.permutations} "
+              f"permutations)")
+        for metric, diff, p in zip(METRICS, observed.tolist(),
+                                   p_values.tolist()):
+            print(f"  {metric}: {diff:+.4f} (p = {p:.4f})")
+    with open(os.path.join(args.out_dir, "significance.json"),
+              'w',
+              encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
 
-            if vis == 1 and inte == 0:
-                process_failures["interpretation"] += 1
 
-            if vis == 1 and inte == 1 and con == 0:
-                process_failures["conclusion"] += 1
+def slices(scored, args):
+    # Every metric per (model, DOK, category, #images, image source) group:
+    # the questions of all files are concatenated into flat columns, joined
+    # with the dataset, and aggregated in one pass.
+    attributes, order = load_sample_attributes(args.dataset)
+    columns = {name: [] for name in SLICE_COLUMNS}
+    sums = {name: [] for name in METRICS}
+    sums.update({name: [] for name in next(iter(scored.values())).failures})
+    for path, result in scored.items():
+        n = result.matrix.shape[1]
+        for name, value in parse_result_name(path, args.data_name,
+                                             args.judge_model).items():
+            columns[name].append(np.full(n, value, dtype=object))
+        joined = question_columns(result.sample_ids, result.positions,
+                                  attributes, order)
+        for name, values in joined.items():
+            columns[name].append(values)
+        for name, values in zip(METRICS, result.matrix):
+            sums[name].append(values)
+        for name, values in result.failures.items():
+            sums[name].append(values)
+    columns = {name: np.concatenate(parts) for name, parts in columns.items()}
+    sums = {name: np.concatenate(parts) for name, parts in sums.items()}
+    rows = slice_metrics(columns, sums, args.slice_by)
+    write_table(rows, args.slices)
+    print(f"\n{len(rows)} slices by {', '.join(args.slice_by)} -> "
+          f"{args.slices}")
 
-            if exp_step == 3:
-                exp_scores.append((vis + vis * inte + vis * inte * con) / exp_step)
-            elif exp_step == 2:
-                exp_scores.append((inte + vis * inte * con) / exp_step)
-            else:
-                raise ValueError
 
-        score_pro = sum(exp_scores) / len(exp_scores)
+def leaderboard(summaries, args):
+    # Per-file Summaries merged per (model, image source), best LCR first;
+    # written to leaderboard.json.
+    merged = {}
+    for path, file_summary in summaries.items():
+        run = parse_result_name(path, args.data_name, args.judge_model)
+        key = (run["model"], run["image_source"])
+        if key not in merged:
+            merged[key] = (Summary(), [])
+        merged[key][0].merge(file_summary)
+        merged[key][1].append(path)
+    rows = []
+    for (model, image_source), (total, paths) in merged.items():
+        sta = total.to_dict()
+        rows.append({
+            "model": model,
+            "image_source": image_source,
+            "files": paths,
+            "num_questions": sta["num_questions"],
+            **{metric: sta[metric] for metric in METRICS}
+        })
+    rows.sort(key=lambda row: row["lcrs_scores"], reverse=True)
+    with open(os.path.join(args.out_dir, "leaderboard.json"),
+              'w',
+              encoding='utf-8') as file:
+        json.dump(rows, file, ensure_ascii=False, indent=2)
 
-        def find_range(num, ranges):
-            return next((k for k in ranges if float(k.split('~')[0]) <= num < float(k.split('~')[1])), None)
 
-        range = find_range(score_pro, process_scores_sta)
-        if range:
-            process_scores_sta[range] += 1
-        elif score_pro == 1.0:
-            process_scores_sta["0.75~1"] += 1
-        else:
-            if f"Question[{i}]" in error:
-                error[f"Question[{i}]"] += f"Error process score: {score_pro}\n"
-            else:
-                error[f"Question[{i}]"] = f"Error process score: {score_pro}\n"
-
-        conclusion_scores.append(score_con)
-        process_scores.append(score_pro)
-        # add score to results
-        results[i]["conc_score"] = score_con
-        results[i]["proc_score"] = score_pro
-
-    lcr = []
-    for c_score, p_score in zip(conclusion_scores, process_scores):
-        if c_score + p_score == 0:
-            lcr.append(0)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file_path",
+        type=str,
+        nargs="+",
+        default=[
+            "eval_results/llm_judgements_open_basic_lingshu_deepseek-v3.2-ca_final_data.json"
+        ],
+        help="judgement files or glob patterns, e.g. 'eval_results/*.json'")
+    parser.add_argument("--out_dir", type=str, default="./sta_result")
+    parser.add_argument("--bootstrap",
+                        type=int,
+                        default=0,
+                        help="bootstrap resamples for CIs of the means "
+                        "(0 = off)")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--compare",
+                        type=str,
+                        nargs=2,
+                        action="append",
+                        metavar=("FILE_A", "FILE_B"),
+                        help="paired permutation test of two result files "
+                        "on their shared questions (repeatable)")
+    parser.add_argument("--permutations", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="processes for the bootstrap")
+    parser.add_argument("--dataset",
+                        type=str,
+                        help="judged dataset (with dok_level and "
+                        "extracted_keywords), for --slices")
+    parser.add_argument("--slices",
+                        type=str,
+                        help="write per-slice metrics to this .csv or "
+                        ".parquet file (needs --dataset)")
+    parser.add_argument("--slice_by",
+                        type=str,
+                        nargs="+",
+                        choices=SLICE_COLUMNS,
+                        default=list(SLICE_COLUMNS))
+    parser.add_argument("--data_name",
+                        type=str,
+                        default="final_data",
+                        help="data name in the result file names; what "
+                        "follows it is the image source tag")
+    parser.add_argument("--judge_model",
+                        type=str,
+                        nargs="+",
+                        default=list(JUDGE_MODELS),
+                        help="judge models in the result file names, for "
+                        "--slices and the --score_cache leaderboard")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="read records one at a time and write "
+                        "Updated_*.jsonl, in constant memory; STA_* files "
+                        "then leave out the per-question score lists")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=1000,
+                        help="records scored at a time with --stream")
+    parser.add_argument("--score_cache",
+                        type=str,
+                        help="SQLite file of per-file summaries; files "
+                        "unchanged since the last run are not read again "
+                        "(implies --stream)")
+    args = parser.parse_args()
+    args.stream = args.stream or bool(args.score_cache)
+    if args.slices and not args.dataset:
+        parser.error("--slices needs --dataset")
+    if args.stream and (args.bootstrap or args.compare or args.slices):
+        parser.error("--stream keeps no per-question scores for --bootstrap, "
+                     "--compare or --slices")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    paths = expand_paths(args.file_path +
+                         [path for pair in args.compare or [] for path in pair])
+    if args.slices or args.score_cache:
+        # Both group files by model; check the names before scoring.
+        for path in paths:
+            try:
+                parse_result_name(path, args.data_name, args.judge_model)
+            except ValueError as e:
+                parser.error(str(e))
+    cache = ScoreCache(args.score_cache) if args.score_cache else None
+    scored = {}
+    streamed = {}
+    summary = []
+    for file_path in paths:
+        print(file_path)
+        if args.stream:
+            streamed[file_path] = stream_file(file_path, args.out_dir,
+                                              args.batch_size, cache)
+            sta = streamed[file_path].to_dict()
+            n = sta["num_questions"]
         else:
-            lcr.append(2 * c_score * p_score / (c_score + p_score))
-    mean_pro = sum(process_scores) / len(process_scores)
-    mean_con = sum(conclusion_scores) / len(conclusion_scores)
-    mean_lcr = sum(lcr) / len(lcr)
-
-    static_results = {
-        "conclusion_scores_sta": conclusion_scores_sta,
-        "process_scores_sta": process_scores_sta,
-        "process_failures": process_failures,
-        "num_exp": num_exp,
-        "error": error,
-        "conclusion_scores": conclusion_scores,
-        "process_scores": process_scores,
-    }
-    static_results['lcrs_scores'] = mean_lcr
-    static_results['proc_scores'] = mean_pro
-    static_results['conc_scores'] = mean_con
-
-    save_path = f"./sta_result/STA_{args.file_path.split('/')[-1]}"
-    with open(save_path, 'w', encoding='utf-8') as file:
-        json.dump(static_results, file, ensure_ascii=False, indent=2)
-    # save the updated results with scores
-    updated_results_path = f"./sta_result/Updated_{args.file_path.split('/')[-1]}"
-    with open(updated_results_path, 'w', encoding='utf-8') as file:
-        json.dump(results, file, ensure_ascii=False, indent=2)
\ No newline at end of file
+            scored[file_path] = analyze_file(file_path, args.out_dir)
+            sta = scored[file_path].static_results
+            n = len(sta["conclusion_scores"])
+        summary.append((os.path.basename(file_path), n, sta["conc_scores"],
+                        sta["proc_scores"], sta["lcrs_scores"]))
+
+    if len(summary) > 1:
+        width = max(len(row[0]) for row in summary)
+        print(f"\n{'file':<{width}} {'n':>6} {'conc':>7} {'proc':>7} "
+              f"{'lcr':>7}")
+        for name, n, conc, proc, lcr in summary:
+            print(f"{name:<{width}} {n:>6} {conc:>7.4f} {proc:>7.4f} "
+                  f"{lcr:>7.4f}")
+
+    if cache is not None:
+        print(f"\nscore cache: {cache.stats()}")
+        cache.close()
+    if args.score_cache:
+        leaderboard(streamed, args)
+
+    if args.bootstrap or args.compare:
+        significance(scored, args)
+
+    if args.slices:
+        slices(scored, args)
@@ -0,0 +1,61 @@
+import json
+import os
+import sqlite3
+
+from scoring import Summary
+
+# Persistent per-file Summaries for incremental re-scoring. A result file's
+# Summary is stored under the file's size and mtime, so a file that has not
+# changed since the last run is not read again, and the leaderboard merges
+# the stored Summaries. Scoring itself is cheap next to reading the records;
+# a changed file is simply streamed and scored again in full.
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class ScoreCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, signature TEXT NOT NULL, "
+                         "summary TEXT NOT NULL)")
+
+    def file_summary(self, path):
+        # The stored Summary of `path`, if the file has not changed since.
+        row = self._db.execute(
+            "SELECT signature, summary FROM files WHERE path = ?",
+            (os.path.abspath(path), )).fetchone()
+        if row is None or row[0] != file_signature(path):
+            return None
+        self.hits += 1
+        return Summary.from_state(json.loads(row[1]))
+
+    def put_file(self, path, signature, summary):
+        # After (re-)scoring `path`.
+        self.misses += 1
+        self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                         (os.path.abspath(path), signature,
+                          json.dumps(summary.to_state(), ensure_ascii=False)))
+        self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        entries = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return {
+            "unchanged_files": self.hits,
+            "rescored_files": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries
+        }
+
+    def close(self):
+        self._db.close()
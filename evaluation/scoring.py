@@ -0,0 +1,248 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Vectorised scoring of judge outputs. The judgements of a result file are
+# flattened once into per-question and per-experiment arrays; conclusion,
+# process and LCR scores, their histograms and the failure counts are then a
+# handful of NumPy operations instead of a Python loop per question.
+
+CONCLUSION_BINS = ["0", "0.25", "0.5", "0.75", "1.0"]
+PROCESS_BINS = ["0~0.25", "0.25~0.5", "0.5~0.75", "0.75~1"]
+PROCESS_EDGES = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+
+# `question` maps every experiment to the index of its question.
+JudgementArrays = namedtuple(
+    "JudgementArrays",
+    ["conclusion", "question", "visual", "interpretation", "sub_conclusion"])
+
+Scores = namedtuple("Scores", ["conc", "proc", "lcr"])
+
+
+def flatten_judgements(judgements):
+    conclusion = np.fromiter(
+        (float(jud["conclusion_score"]) for jud in judgements),
+        dtype=float,
+        count=len(judgements)) / 4
+    rows = [(i, exp["visual_phenomenon"], exp["interpretation"],
+             exp["sub-conclusion"]) for i, jud in enumerate(judgements)
+            for exp in jud["experiments"]]
+    exps = np.array(rows, dtype=float).reshape(-1, 4)
+    return JudgementArrays(conclusion, exps[:, 0].astype(np.int64),
+                           exps[:, 1], exps[:, 2], exps[:, 3])
+
+
+def visual_flags(arrays):
+    # A visual phenomenon judged -1 cannot be checked; it counts as correct
+    # and the experiment is scored on its two remaining steps.
+    return np.where(arrays.visual == -1, 1.0, arrays.visual)
+
+
+def score_judgements(arrays, offset=0):
+    # `offset` is the index of the first question, for messages about a
+    # batch of a longer file.
+    n = len(arrays.conclusion)
+    vis = visual_flags(arrays)
+    inte = arrays.interpretation
+    con = arrays.sub_conclusion
+    exp_scores = np.where(arrays.visual == -1, (inte + vis * inte * con) / 2,
+                          (vis + vis * inte + vis * inte * con) / 3)
+    counts = np.bincount(arrays.question, minlength=n)
+    if n and not counts.all():
+        raise ValueError(
+            f"Question[{offset + int(np.argmin(counts))}] has no experiments")
+    # bincount adds in input order, like summing each question's list.
+    proc = np.bincount(arrays.question, weights=exp_scores,
+                       minlength=n) / np.maximum(counts, 1)
+    conc = arrays.conclusion
+    total = conc + proc
+    lcr = np.divide(2 * conc * proc,
+                    total,
+                    out=np.zeros(n),
+                    where=total != 0)
+    return Scores(conc, proc, lcr)
+
+
+def question_failures(arrays):
+    # Per-question experiment and failure counts, as summed in summarize().
+    n = len(arrays.conclusion)
+    vis = visual_flags(arrays)
+    inte = arrays.interpretation
+    con = arrays.sub_conclusion
+    flags = {
+        "num_exp": np.ones(len(vis)),
+        "visual_failures": vis == 0,
+        "interpretation_failures": (vis == 1) & (inte == 0),
+        "conclusion_failures": (vis == 1) & (inte == 1) & (con == 0)
+    }
+    return {
+        name: np.bincount(arrays.question, weights=flag,
+                          minlength=n).astype(np.int64)
+        for name, flag in flags.items()
+    }
+
+
+def sequential_sum(values, start=0.0):
+    # Summed left to right like Python's sum() (np.mean sums pairwise), so the
+    # means match earlier STA_* files to the last digit. Continuing from
+    # `start` keeps that order when a file is summed batch by batch.
+    return float(np.cumsum(np.concatenate([[start], values]))[-1])
+
+
+def sequential_mean(values):
+    return sequential_sum(values) / len(values) if len(values) else 0.0
+
+
+def process_bins(proc):
+    # Index into PROCESS_BINS; a score of exactly 1 falls into the last bin,
+    # anything outside [0, 1] (or NaN) gets -1.
+    idx = np.searchsorted(PROCESS_EDGES, proc, side="right") - 1
+    idx[proc == 1.0] = len(PROCESS_BINS) - 1
+    idx[(idx < 0) | (idx >= len(PROCESS_BINS)) | np.isnan(proc)] = -1
+    return idx
+
+
+def score_histograms(scores, offset=0):
+    # Conclusion / process histograms and {question index: message} for
+    # scores outside the bins; indices count from `offset`.
+    conc, proc = scores.conc, scores.proc
+    conc_values = np.array([float(k) for k in CONCLUSION_BINS])
+    conc_hits = conc[:, None] == conc_values
+    proc_idx = process_bins(proc)
+    conc_bad = ~conc_hits.any(axis=1)
+    proc_bad = proc_idx < 0
+
+    error = {}
+    for i in np.flatnonzero(conc_bad | proc_bad):
+        message = ""
+        if conc_bad[i]:
+            message += f"Error conclusion score: {float(conc[i])}\n"
+        if proc_bad[i]:
+            message += f"Error process score: {float(proc[i])}\n"
+        error[offset + int(i)] = message
+
+    conclusion = dict(zip(CONCLUSION_BINS, conc_hits.sum(axis=0).tolist()))
+    process = dict(
+        zip(PROCESS_BINS,
+            np.bincount(proc_idx[~proc_bad],
+                        minlength=len(PROCESS_BINS)).tolist()))
+    return conclusion, process, error
+
+
+def summarize(arrays, scores, offset=0):
+    # Histograms, failure counts and per-question errors, in the layout of
+    # the STA_* files; error keys count from `offset`.
+    vis = visual_flags(arrays)
+    inte = arrays.interpretation
+    con = arrays.sub_conclusion
+    conclusion, process, error = score_histograms(scores, offset)
+
+    return {
+        "conclusion_scores_sta": conclusion,
+        "process_scores_sta": process,
+        "process_failures": {
+            "visual": int((vis == 0).sum()),
+            "interpretation": int(((vis == 1) & (inte == 0)).sum()),
+            "conclusion": int(((vis == 1) & (inte == 1) & (con == 0)).sum())
+        },
+        "num_exp": len(arrays.question),
+        "error": {f"Question[{i}]": message for i, message in error.items()}
+    }
+
+
+class Summary:
+    # Running STA_* totals that batches are added to in file order, for
+    # files too large to score at once. Holds no per-question lists, so its
+    # size does not grow with the file (apart from `error`). Summaries can be
+    # saved with to_state() and merged, e.g. the shards of one run.
+
+    FAILURES = {
+        "visual": "visual_failures",
+        "interpretation": "interpretation_failures",
+        "conclusion": "conclusion_failures"
+    }
+
+    def __init__(self):
+        self.n = 0
+        self.sums = dict.fromkeys(("lcrs_scores", "proc_scores",
+                                   "conc_scores"), 0.0)
+        self.conclusion = dict.fromkeys(CONCLUSION_BINS, 0)
+        self.process = dict.fromkeys(PROCESS_BINS, 0)
+        self.failures = dict.fromkeys(self.FAILURES, 0)
+        self.num_exp = 0
+        # {question index: message}
+        self.error = {}
+
+    def add(self, scores, failures):
+        # `failures` are the per-question counts of question_failures().
+        conclusion, process, error = score_histograms(scores, offset=self.n)
+        for name, values in (("conc_scores", scores.conc),
+                             ("proc_scores", scores.proc),
+                             ("lcrs_scores", scores.lcr)):
+            self.sums[name] = sequential_sum(values, self.sums[name])
+        for key, count in conclusion.items():
+            self.conclusion[key] += count
+        for key, count in process.items():
+            self.process[key] += count
+        for key, column in self.FAILURES.items():
+            self.failures[key] += int(failures[column].sum())
+        self.num_exp += int(failures["num_exp"].sum())
+        self.error.update(error)
+        self.n += len(scores.conc)
+
+    def merge(self, other):
+        # Appends `other` as if its questions followed these.
+        for name in self.sums:
+            self.sums[name] += other.sums[name]
+        for mine, theirs in ((self.conclusion, other.conclusion),
+                             (self.process, other.process),
+                             (self.failures, other.failures)):
+            for key, count in theirs.items():
+                mine[key] += count
+        self.num_exp += other.num_exp
+        self.error.update(
+            {self.n + i: message for i, message in other.error.items()})
+        self.n += other.n
+        return self
+
+    def to_state(self):
+        return {
+            "n": self.n,
+            "sums": self.sums,
+            "conclusion": self.conclusion,
+            "process": self.process,
+            "failures": self.failures,
+            "num_exp": self.num_exp,
+            "error": self.error
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        summary = cls()
+        for name in ("n", "sums", "conclusion", "process", "failures",
+                     "num_exp"):
+            setattr(summary, name, state[name])
+        # JSON turns the integer keys into strings.
+        summary.error = {
+            int(i): message
+            for i, message in state["error"].items()
+        }
+        return summary
+
+    def to_dict(self):
+        # The STA_* layout without the per-question score lists.
+        return {
+            "conclusion_scores_sta": dict(self.conclusion),
+            "process_scores_sta": dict(self.process),
+            "process_failures": dict(self.failures),
+            "num_exp": self.num_exp,
+            "error": {
+                f"Question[{i}]": message
+                for i, message in sorted(self.error.items())
+            },
+            "num_questions": self.n,
+            **{
+                name: total / self.n if self.n else 0.0
+                for name, total in self.sums.items()
+            }
+        }
@@ -0,0 +1,79 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Uncertainty of the mean scores. Both tests work on a (metrics x questions)
+# matrix of per-question scores and draw their resamples as whole index / sign
+# matrices, a chunk at a time, so every metric is handled by the same few
+# array operations per chunk.
+
+# Upper bound on the elements of one resample matrix (rows x questions).
+CHUNK_ELEMENTS = 1 << 22
+
+
+def _chunks(resamples, n):
+    rows = max(1, CHUNK_ELEMENTS // max(n, 1))
+    for start in range(0, resamples, rows):
+        yield min(rows, resamples - start)
+
+
+def bootstrap_ci(values, resamples=10000, alpha=0.05, seed=0):
+    # Percentile intervals of the mean of every row of `values`. Returns a
+    # (metrics, 2) array of (low, high).
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    n = values.shape[1]
+    rng = np.random.default_rng(seed)
+    means = []
+    for rows in _chunks(resamples, n):
+        idx = rng.integers(0, n, size=(rows, n))
+        # How often each question was drawn per resample; the resampled
+        # means of all metrics are then one matrix product.
+        counts = np.bincount((idx + np.arange(rows)[:, None] * n).ravel(),
+                             minlength=rows * n).reshape(rows, n)
+        means.append(values @ counts.T / n)
+    means = np.concatenate(means, axis=1)
+    return np.quantile(means, [alpha / 2, 1 - alpha / 2], axis=1).T
+
+
+def paired_permutation_test(a, b, resamples=10000, seed=0):
+    # Two-sided sign-flip test of mean(a - b) == 0 for every row of the
+    # paired (metrics, questions) matrices. Returns (observed differences,
+    # p-values).
+    diff = np.atleast_2d(np.asarray(a, dtype=float) -
+                         np.asarray(b, dtype=float))
+    n = diff.shape[1]
+    observed = diff.mean(axis=1)
+    rng = np.random.default_rng(seed)
+    extreme = np.zeros(len(diff), dtype=np.int64)
+    for rows in _chunks(resamples, n):
+        signs = rng.integers(0, 2, size=(rows, n)) * 2.0 - 1.0
+        stats = diff @ signs.T / n
+        # Tolerance so ties with the observed value are counted as ties.
+        extreme += (np.abs(stats) >=
+                    np.abs(observed)[:, None] - 1e-12).sum(axis=1)
+    return observed, (extreme + 1) / (resamples + 1)
+
+
+def paired_scores(keys_a, values_a, keys_b, values_b):
+    # Columns of both score matrices restricted to the questions present in
+    # both files, matched by key (first occurrence of a duplicated key).
+    keys_a = np.asarray([str(k) for k in keys_a])
+    keys_b = np.asarray([str(k) for k in keys_b])
+    _, ia, ib = np.intersect1d(keys_a, keys_b, return_indices=True)
+    return np.asarray(values_a)[:, ia], np.asarray(values_b)[:, ib]
+
+
+def _bootstrap_task(args):
+    return bootstrap_ci(*args)
+
+
+def bootstrap_many(matrices, resamples=10000, alpha=0.05, seed=0, workers=1):
+    # bootstrap_ci for several files, optionally in a process pool. Every file
+    # gets its own seed derived from `seed`, so results do not depend on the
+    # number of workers.
+    seeds = np.random.SeedSequence(seed).spawn(len(matrices))
+    tasks = [(m, resamples, alpha, s) for m, s in zip(matrices, seeds)]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_bootstrap_task, tasks))
+    return [_bootstrap_task(task) for task in tasks]
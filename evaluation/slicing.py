@@ -0,0 +1,154 @@
+import csv
+import os
+import re
+
+import numpy as np
+
+from streaming import iter_records
+
+# Metrics per slice of the benchmark. Every scored question becomes one row of
+# a few flat columns (model and image source from the result file name, DOK
+# level, main category and image count from the dataset, joined on
+# original_sample_index); all slices are then aggregated in one grouped pass
+# over those columns and written as a tidy table, one row per group.
+
+SLICE_COLUMNS = ("model", "dok_level", "category", "num_images",
+                 "image_source")
+# Summed per group; the *_scores means are derived from the sums.
+SUM_COLUMNS = ("conc_scores", "proc_scores", "lcrs_scores", "num_exp",
+               "visual_failures", "interpretation_failures",
+               "conclusion_failures")
+
+# Judge models of the evaluation notebook; the judge segment of a result file
+# name is matched against these, as model names may contain underscores.
+JUDGE_MODELS = ("deepseek-v3.2-ca", "qwen3-235b-ca")
+CATEGORY_RE = re.compile(r"^\s*\[([^\]]+)\]")
+DOK_RE = re.compile(r"\d")
+IMAGE_TAG_RE = re.compile(r"\[Image (\d+)\]")
+
+
+def parse_result_name(path, data_name, judge_models=JUDGE_MODELS):
+    # Model and image source of a result file named like the evaluation
+    # notebook's `llm_judgements_{type}_{difficulty}_{answer_model}_
+    # {judge_model}_{data_name}[_{tag}].json`. The answer model is whatever
+    # lies between the difficulty and a known judge followed by `data_name`;
+    # the run tag (e.g. no_images) tells image sources apart, untagged runs
+    # are "default". Raises ValueError for names of another shape.
+    stem = os.path.splitext(os.path.basename(path))[0]
+    judges = "|".join(re.escape(judge) for judge in judge_models)
+    match = re.match(
+        rf"^llm_judgements_[^_]+_[^_]+_(?P<model>.+)_(?:{judges})_"
+        rf"{re.escape(data_name)}(?:_(?P<tag>.+))?$", stem)
+    if not match:
+        raise ValueError(
+            f"{path}: not an llm_judgements_<type>_<difficulty>_<model>_"
+            f"<judge>_{data_name}[_<tag>] file (judges: "
+            f"{', '.join(judge_models)})")
+    return {
+        "model": match.group("model"),
+        "image_source": match.group("tag") or "default"
+    }
+
+
+def dok_level(value):
+    # The DOK judge answers free text ("2", "DOK 2", "Level 2: ...").
+    match = DOK_RE.search(str(value)) if value is not None else None
+    return match.group(0) if match else "unknown"
+
+
+def main_category(sample):
+    match = CATEGORY_RE.match(sample.get("extracted_keywords") or "")
+    return match.group(1).strip() if match else "unknown"
+
+
+def image_count(sample):
+    for key in ("image_info", "image_captions", "context_enhanced_captions"):
+        if isinstance(sample.get(key), list):
+            return len(sample[key])
+    return len(set(IMAGE_TAG_RE.findall(sample.get("input_observation", ""))))
+
+
+def load_sample_attributes(path):
+    # ({str(original_sample_index): (dok_level, category, num_images)},
+    #  [original_sample_index by dataset position]). Only these fields are
+    # kept, not the samples.
+    attributes = {}
+    order = []
+    for sample in iter_records(path):
+        oid = str(sample.get("original_sample_index"))
+        attributes[oid] = (dok_level(sample.get("dok_level")),
+                           main_category(sample), image_count(sample))
+        order.append(oid)
+    return attributes, order
+
+
+def question_columns(sample_ids, positions, attributes, order):
+    # Dataset attributes of every question. Judgement records without an
+    # original_sample_index are joined through their question_index, the
+    # position in the judged dataset.
+    unknown = ("unknown", "unknown", -1)
+    rows = []
+    for oid, pos in zip(sample_ids, positions):
+        if oid is None and pos is not None and 0 <= pos < len(order):
+            oid = order[pos]
+        rows.append(attributes.get(str(oid), unknown))
+    dok, category, num_images = zip(*rows) if rows else ((), (), ())
+    return {
+        "dok_level": np.array(dok, dtype=object),
+        "category": np.array(category, dtype=object),
+        "num_images": np.array(num_images, dtype=np.int64)
+    }
+
+
+def slice_metrics(columns, sums, by=SLICE_COLUMNS):
+    # One grouped pass: the `by` columns are factorised, combined into a
+    # single group id per question, and every column of `sums` is summed per
+    # group with bincount. Returns tidy rows sorted by group.
+    codes, levels = [], []
+    for name in by:
+        uniques, inverse = np.unique(columns[name], return_inverse=True)
+        codes.append(inverse.ravel())
+        levels.append(uniques)
+    shape = [len(level) for level in levels]
+    group = np.ravel_multi_index(codes, shape)
+    groups, inverse = np.unique(group, return_inverse=True)
+    counts = np.bincount(inverse)
+    totals = {
+        name: np.bincount(inverse, weights=values, minlength=len(groups))
+        for name, values in sums.items()
+    }
+    keys = np.unravel_index(groups, shape)
+    rows = []
+    for g in range(len(groups)):
+        row = {}
+        for i, name in enumerate(by):
+            value = levels[i][keys[i][g]]
+            row[name] = value.item() if isinstance(value, np.generic) else value
+        row["n"] = int(counts[g])
+        for name in SUM_COLUMNS:
+            if name.endswith("_scores"):
+                row[name] = float(totals[name][g] / counts[g])
+            else:
+                row[name] = int(totals[name][g])
+        rows.append(row)
+    return rows
+
+
+def write_table(rows, path):
+    # Parquet needs pandas (with pyarrow or fastparquet); anything else is
+    # written as CSV.
+    if path.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError(
+                "writing Parquet needs pandas and pyarrow; use a .csv path "
+                "instead") from None
+        pd.DataFrame(rows).to_parquet(path, index=False)
+        return
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if not rows:
+            return
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,98 @@
+import json
+import os
+
+from score_cache import file_signature
+from scoring import (Summary, flatten_judgements, question_failures,
+                     score_judgements)
+
+# Scoring without loading the file. Records are read one at a time from a JSON
+# array or JSONL file, scored in fixed-size batches with the vectorised
+# scorer, and written straight back out as JSONL; only the running Summary is
+# kept, so memory depends on the batch size and not on the number of answers.
+
+READ_CHUNK = 1 << 20
+
+
+def iter_records(path, chunk_size=READ_CHUNK):
+    # Top-level elements of a JSON array, or the lines of a JSONL file.
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf = f.read(chunk_size)
+        pos = len(buf) - len(buf.lstrip())
+        if buf[pos:pos + 1] != "[":
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        pos += 1
+        eof = False
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","):
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            if eof and pos >= len(buf):
+                raise ValueError(f"{path}: unterminated JSON array")
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            # A value running up to the end of the buffer may be cut off.
+            if end is None or (end == len(buf) and not eof):
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield record
+            pos = end
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_file(file_path, out_dir, batch_size=1000, cache=None):
+    # Writes Updated_<name>.jsonl (every record with conc_score / proc_score)
+    # and STA_<name> without the per-question score lists; returns the
+    # Summary. With a ScoreCache, a file unchanged since its last run (whose
+    # Updated_ file is still there) is not read again.
+    name = os.path.basename(file_path)
+    updated_path = os.path.join(out_dir,
+                                f"Updated_{os.path.splitext(name)[0]}.jsonl")
+    summary = None
+    if cache is not None and os.path.exists(updated_path):
+        summary = cache.file_summary(file_path)
+    if summary is None:
+        summary = Summary()
+        signature = file_signature(file_path)
+        with open(updated_path, 'w', encoding='utf-8') as out:
+            for batch in _batches(iter_records(file_path), batch_size):
+                arrays = flatten_judgements(
+                    [data["judgement"] for data in batch])
+                scores = score_judgements(arrays, offset=summary.n)
+                summary.add(scores, question_failures(arrays))
+                for data, score_con, score_pro in zip(
+                        batch, scores.conc.tolist(), scores.proc.tolist()):
+                    data["conc_score"] = score_con
+                    data["proc_score"] = score_pro
+                    out.write(json.dumps(data, ensure_ascii=False) + "\n")
+        if cache is not None:
+            cache.put_file(file_path, signature, summary)
+    with open(os.path.join(out_dir, f"STA_{name}"), 'w',
+              encoding='utf-8') as file:
+        json.dump(summary.to_dict(), file, ensure_ascii=False, indent=2)
+    return summary
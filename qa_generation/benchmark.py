@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import re
+import time
+import types
+from collections import OrderedDict
+
+import qa_generation as qa
+from corpus_reader import Corpus
+from prefilter import sample_text
+
+# Offline benchmarks for request-shaping options of the pipeline. By default
+# they run against a simulated endpoint (fixed overhead per request, prefill
+# and decode cost per token, a limited number of parallel slots and an
+# optional vLLM-style prefix cache) so numbers are comparable across machines;
+# --real sends the requests to the configured text endpoint instead.
+
+
+KEYWORDS_ANSWER = "[Clinical Medicine]: " + ", ".join(["keyword"] * 12)
+
+
+class SimulatedEndpoint:
+
+    def __init__(self,
+                 slots=8,
+                 request_overhead=0.25,
+                 prefill_per_token=0.00005,
+                 decode_per_token=0.01,
+                 prefix_cache_tokens=0,
+                 block_tokens=16):
+        self.slots = slots
+        self.request_overhead = request_overhead
+        self.prefill_per_token = prefill_per_token
+        self.decode_per_token = decode_per_token
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        # Prefix cache: LRU of full token blocks keyed by the hash of the
+        # whole prefix up to and including the block, as in vLLM.
+        self.block_chars = block_tokens * qa.CHARS_PER_TOKEN
+        self.cache_blocks = prefix_cache_tokens // block_tokens
+        self._blocks = OrderedDict()
+        self._sem = None
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(
+            create=self._create))
+
+    def _answer(self, text):
+        ids = [int(i) for i in re.findall(r"original_sample_index=(\d+)", text)]
+        if "several independent items" in text:
+            return json.dumps([{
+                "original_sample_index": i,
+                "keywords": KEYWORDS_ANSWER
+            } for i in ids])
+        if ids:
+            return json.dumps([{
+                "original_sample_index": i,
+                "is_biomedical": True
+            } for i in ids])
+        if "thematic classification" in text:
+            return KEYWORDS_ANSWER
+        return '{"is_biomedical": true}'
+
+    def _cached_prefix_tokens(self, text):
+        if not self.cache_blocks:
+            return 0
+        h = hashlib.sha256()
+        cached = 0
+        hit = True
+        for start in range(0, len(text) - self.block_chars + 1,
+                           self.block_chars):
+            h.update(text[start:start + self.block_chars].encode("utf-8"))
+            key = h.hexdigest()
+            if hit and key in self._blocks:
+                self._blocks.move_to_end(key)
+                cached += self.block_chars
+                continue
+            hit = False
+            self._blocks[key] = True
+            if len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+        return cached // qa.CHARS_PER_TOKEN
+
+    async def _create(self, model, messages, **kwargs):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.slots)
+        # Chat template: messages in order, roles as separators.
+        text = "".join(
+            f"<|{m['role']}|>" + (m["content"] if isinstance(
+                m["content"], str) else "".join(
+                    p.get("text", "") for p in m["content"]))
+            for m in messages)
+        answer = self._answer(text)
+        prompt_tokens = len(text) // qa.CHARS_PER_TOKEN
+        completion_tokens = len(answer) // qa.CHARS_PER_TOKEN
+        async with self._sem:
+            self.requests += 1
+            cached = self._cached_prefix_tokens(text)
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached
+            await asyncio.sleep(self.request_overhead +
+                                (prompt_tokens - cached) *
+                                self.prefill_per_token +
+                                completion_tokens * self.decode_per_token)
+        return types.SimpleNamespace(
+            choices=[
+                types.SimpleNamespace(
+                    message=types.SimpleNamespace(content=answer),
+                    finish_reason="stop")
+            ],
+            usage=types.SimpleNamespace(prompt_tokens=prompt_tokens,
+                                        completion_tokens=completion_tokens,
+                                        total_tokens=prompt_tokens +
+                                        completion_tokens))
+
+
+def load_samples(path, limit):
+    samples = list(itertools.islice(Corpus(path), limit))
+    for sample in samples:
+        # Step 1 consumes the lightweight Step 0 output.
+        sample.setdefault("image_captions", [{
+            "image_index": i + 1,
+            "caption": img.get("caption", "")
+        } for i, img in enumerate(sample.get("image_info", []))])
+    return samples
+
+
+async def run_batching(samples, stage, batch_size, endpoint):
+    qa.local_text_client = endpoint
+    qa.text_limiter = qa.EndpointLimiter("benchmark",
+                                         max_concurrency=256,
+                                         overload_errors=qa.RETRYABLE_ERRORS)
+    if stage == "filter":
+        single, handle_batch = (qa.check_biomedical_async,
+                                qa.check_biomedical_batch)
+    else:
+        single, handle_batch = (qa.extract_keywords_from_filtered_async,
+                                qa.extract_keywords_batch)
+    batcher = None
+    if batch_size > 1:
+        batcher = qa.MicroBatcher(handle_batch, batch_size,
+                                  qa.TEXT_BATCH_MAX_WAIT)
+    start = time.monotonic()
+    await asyncio.gather(*(single(s, batcher) for s in samples))
+    return time.monotonic() - start
+
+
+def benchmark_batching(args):
+    samples = load_samples(args.input, args.num_samples)
+    print(f"{'K':>4} {'requests':>9} {'seconds':>8} {'items/s':>8}")
+    for batch_size in args.batch_sizes:
+        endpoint = qa.local_text_client if args.real else SimulatedEndpoint(
+            slots=args.slots)
+        qa.usage_totals.clear()
+        elapsed = asyncio.run(
+            run_batching(samples, args.stage, batch_size, endpoint))
+        requests = sum(t["requests"] for t in qa.usage_totals.values())
+        print(f"{batch_size:>4} {requests:>9} {elapsed:>8.2f} "
+              f"{len(samples) / elapsed:>8.1f}")
+
+
+PREFIX_CACHE_TEMPLATES = {
+    "keywords": "KEYWORD_Category_PROMPT_TEMPLATE",
+    "consensus": "CONSENSUS_PROMPT_TEMPLATE",
+    "enhanced_caption": "ENHANCED_CAPTION_PROMPT_TEMPLATE",
+    "visual_qa": "VISUAL_ELEMENT_QA_PROMPT_TEMPLATE",
+    "logic_chain": "LOGIC_CHAIN_PROMPT_TEMPLATE",
+    "open_qa": "OPEN_ENDED_QA_GENERATION_PROMPT_TEMPLATE"
+}
+
+
+async def run_prefix_cache(samples, template, endpoint):
+    qa.local_text_client = endpoint
+    qa.text_limiter = qa.EndpointLimiter("benchmark",
+                                         max_concurrency=256,
+                                         overload_errors=qa.RETRYABLE_ERRORS)
+    fields = qa.PLACEHOLDER_RE.findall(template)
+    latencies = []
+
+    async def one(sample):
+        # Every placeholder gets this sample's own text, which is all the
+        # cache cares about: it differs between samples.
+        text = sample_text(sample)[:2000]
+        prev_messages, prompt = qa.build_prompt(
+            template, **{name: text for name in fields})
+        result = await qa.get_response_async(prev_messages, prompt,
+                                             qa.TEXT_MODEL_NAME, endpoint)
+        latencies.append(result["latency"])
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(s) for s in samples))
+    return time.monotonic() - start, sum(latencies) / len(latencies)
+
+
+def benchmark_prefix_cache(args):
+    samples = load_samples(args.input, args.num_samples)
+    print(f"{'template':>17} {'layout':>14} {'cached':>7} {'seconds':>8} "
+          f"{'avg latency':>12}")
+    for name in args.templates:
+        template = getattr(qa, PREFIX_CACHE_TEMPLATES[name])
+        for layout in (False, True):
+            qa.PROMPT_PREFIX_CACHING = layout
+            endpoint = SimulatedEndpoint(
+                slots=args.slots,
+                request_overhead=0.05,
+                prefix_cache_tokens=args.cache_tokens)
+            elapsed, latency = asyncio.run(
+                run_prefix_cache(samples, template, endpoint))
+            cached = endpoint.cached_tokens / max(endpoint.prompt_tokens, 1)
+            print(f"{name:>17} "
+                  f"{'system-prefix' if layout else 'inline':>14} "
+                  f"{cached:>7.1%} {elapsed:>8.2f} {latency:>11.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the QA generation pipeline.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("batching",
+                       help="throughput of Step 0 / Step 1 against the "
+                       "number of samples per request (K)")
+    p.add_argument("--input", type=str, default=qa.INPUT_SOURCE_FILE)
+    p.add_argument("--stage",
+                   choices=["filter", "keywords"],
+                   default="filter")
+    p.add_argument("--num_samples", type=int, default=256)
+    p.add_argument("--batch_sizes",
+                   type=int,
+                   nargs="+",
+                   default=[1, 2, 4, 8, 16, 32])
+    p.add_argument("--slots",
+                   type=int,
+                   default=8,
+                   help="parallel requests of the simulated endpoint")
+    p.add_argument("--real",
+                   action="store_true",
+                   help="use the configured text endpoint instead")
+
+    p = sub.add_parser("prefix-cache",
+                       help="prefill savings of PROMPT_PREFIX_CACHING on a "
+                       "simulated endpoint with a prefix cache")
+    p.add_argument("--input", type=str, default=qa.INPUT_SOURCE_FILE)
+    p.add_argument("--templates",
+                   nargs="+",
+                   choices=sorted(PREFIX_CACHE_TEMPLATES),
+                   default=sorted(PREFIX_CACHE_TEMPLATES))
+    p.add_argument("--num_samples", type=int, default=128)
+    p.add_argument("--slots", type=int, default=8)
+    p.add_argument("--cache_tokens",
+                   type=int,
+                   default=200000,
+                   help="prefix cache capacity of the simulated endpoint")
+
+    args = parser.parse_args()
+    # Benchmarks measure fresh requests only, all sent to the endpoint; their
+    # simulated verdicts must not end up in the prefilter's training labels.
+    qa.response_cache = None
+    qa.step0_labels = None
+    qa.prefilter = None
+    if args.command == "batching":
+        benchmark_batching(args)
+    elif args.command == "prefix-cache":
+        benchmark_prefix_cache(args)
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+# Append-only, per-sample checkpoint store for the QA generation pipeline.
+# Every finished (stage, original_sample_index) pair is written as one JSONL
+# record together with the fingerprint of the prompt template(s) and model that
+# produced it. On restart, records whose fingerprint still matches are reused
+# and only missing or invalidated samples are sent to the endpoints again.
+
+
+def stage_fingerprint(parent, *parts):
+    # Chained with the previous stage's fingerprint, so editing an upstream
+    # prompt also invalidates every downstream stage.
+    h = hashlib.sha256((parent or "").encode("utf-8"))
+    for part in parts:
+        h.update(b"\x00")
+        h.update(str(part).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+class CheckpointStore:
+    # Only (fingerprint, file offset) is kept in memory; results are read back
+    # from disk on demand so resuming a large run stays cheap.
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+        tail_ok = True
+        if os.path.exists(path):
+            tail_ok = self._load()
+        self._writer = open(path, 'ab')
+        if not tail_ok:
+            self._writer.write(b"\n")
+        self._reader = open(path, 'rb')
+
+    def _load(self):
+        offset = 0
+        line = b"\n"
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave a truncated last line behind.
+                    offset += len(line)
+                    continue
+                key = (rec["stage"], str(rec["original_sample_index"]))
+                self.records[key] = (rec["fingerprint"], offset)
+                offset += len(line)
+        return line.endswith(b"\n")
+
+    def get(self, stage, oid, fingerprint):
+        fp, offset = self.records.get((stage, str(oid)), (None, None))
+        if fp != fingerprint:
+            self.misses += 1
+            return False, None
+        self._reader.seek(offset)
+        rec = json.loads(self._reader.readline())
+        self.hits += 1
+        return True, rec["result"]
+
+    def put(self, stage, oid, fingerprint, result):
+        line = json.dumps(
+            {
+                "stage": stage,
+                "original_sample_index": oid,
+                "fingerprint": fingerprint,
+                "result": result
+            },
+            ensure_ascii=False) + "\n"
+        self._writer.seek(0, os.SEEK_END)
+        self.records[(stage, str(oid))] = (fingerprint, self._writer.tell())
+        self._writer.write(line.encode("utf-8"))
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+        self._reader.close()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import mmap
+import os
+import re
+
+# Lazy access to the input corpus (a JSON array of samples or JSONL). The file
+# is scanned once for the byte span of every top-level sample, and the spans
+# are saved next to it as `<path>.idx.json` (original_sample_index -> offset,
+# length, in file order). Afterwards samples are parsed one at a time, either
+# sequentially or by original_sample_index, so neither the pipeline nor the
+# image lookup of Step 2b has to hold the whole corpus in memory.
+
+# Bytes that change the scanner state. Inside long base64 strings none of
+# them occur, so the regex skips those in C.
+_STRUCTURAL_RE = re.compile(rb'["\\\[\]{}]')
+
+
+def iter_array_spans(buf):
+    # (offset, length) of every top-level object in a JSON array.
+    pos = buf.find(b"[") + 1
+    if pos == 0:
+        raise ValueError("not a JSON array")
+    depth = 0
+    start = None
+    in_string = False
+    while True:
+        m = _STRUCTURAL_RE.search(buf, pos)
+        if m is None:
+            return
+        c = buf[m.start():m.start() + 1]
+        pos = m.end()
+        if in_string:
+            if c == b"\\":
+                pos += 1
+            elif c == b'"':
+                in_string = False
+        elif c == b'"':
+            in_string = True
+        elif c in (b"{", b"["):
+            if depth == 0:
+                start = m.start()
+            depth += 1
+        elif depth == 0:
+            return  # closing bracket of the array itself
+        else:
+            depth -= 1
+            if depth == 0:
+                yield start, m.end() - start
+
+
+def iter_jsonl_spans(buf):
+    offset = 0
+    size = len(buf)
+    while offset < size:
+        end = buf.find(b"\n", offset)
+        end = size if end < 0 else end + 1
+        if buf[offset:end].strip():
+            yield offset, end - offset
+        offset = end
+
+
+def _first_byte(buf):
+    for i in range(min(len(buf), 4096)):
+        if buf[i:i + 1] not in (b" ", b"\t", b"\r", b"\n", b"\xef", b"\xbb",
+                                b"\xbf"):
+            return buf[i:i + 1]
+    return b""
+
+
+def build_index(path, index_path):
+    entries = []
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if _first_byte(buf) == b"[":
+                    spans = iter_array_spans(buf)
+                else:
+                    spans = iter_jsonl_spans(buf)
+                for offset, length in spans:
+                    sample = json.loads(buf[offset:offset + length])
+                    entries.append(
+                        [sample.get("original_sample_index"), offset, length])
+    stat = os.stat(path)
+    index = {
+        "version": 1,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "samples": entries
+    }
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def load_index(path, index_path):
+    # Rebuilt whenever the corpus file changed since the index was written.
+    stat = os.stat(path)
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if (index.get("size") == stat.st_size
+                and index.get("mtime") == stat.st_mtime):
+            return index
+    return build_index(path, index_path)
+
+
+class Corpus:
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx.json"
+        entries = load_index(path, self.index_path)["samples"]
+        self.ids = [oid for oid, _, _ in entries]
+        self.spans = {str(oid): (offset, length)
+                      for oid, offset, length in entries}
+        self._file = open(path, 'rb')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, oid):
+        return str(oid) in self.spans
+
+    def _read(self, offset, length):
+        self._file.seek(offset)
+        return json.loads(self._file.read(length))
+
+    def get(self, oid, default=None):
+        span = self.spans.get(str(oid))
+        return default if span is None else self._read(*span)
+
+    def __iter__(self):
+        # Samples in file order, parsed one at a time.
+        for oid in self.ids:
+            yield self._read(*self.spans[str(oid)])
+
+    def restrict(self, keep):
+        # Iterate only the samples whose original_sample_index passes
+        # `keep`; get() still reaches every sample.
+        self.ids = [oid for oid in self.ids if keep(oid)]
+
+    def positions(self):
+        return {oid: i for i, oid in enumerate(self.ids)}
+
+    def close(self):
+        self._file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build (or refresh) the offset index of an input corpus.")
+    parser.add_argument("path", type=str)
+    parser.add_argument("--index", type=str, default=None)
+    args = parser.parse_args()
+
+    corpus = Corpus(args.path, args.index)
+    print(f"{len(corpus)} samples indexed in {corpus.index_path}")
@@ -0,0 +1,111 @@
+import argparse
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+# Downscaled, re-encoded copies of the images sent to VL models. Entries are
+# keyed by the hash of the source bytes plus the resize settings, so every
+# image is decoded and re-encoded at most once across runs and models.
+
+
+class ResizedImageCache:
+
+    def __init__(self, cache_dir, max_side=1536, quality=85):
+        self.cache_dir = cache_dir
+        self.max_side = max_side
+        self.quality = quality
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+        # Directories are only created by the first write (see get), so
+        # importing a module that builds a cache leaves the disk alone.
+
+    def _path(self, data):
+        key = hashlib.sha256(data).hexdigest()
+        name = f"{key}_{self.max_side}_q{self.quality}.jpg"
+        return os.path.join(self.cache_dir, key[:2], name)
+
+    def _resize(self, data):
+        try:
+            return self._reencode(data)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            # Corrupt or unsupported image: send the bytes as they are, as
+            # without the cache, so the endpoint reports this one image.
+            self.errors += 1
+            return bytes(data)
+
+    def _reencode(self, data):
+        img = Image.open(BytesIO(data))
+        is_jpeg = img.format == "JPEG"
+        scale = max(img.size) / self.max_side
+        if is_jpeg and scale <= 1:
+            # Already small enough; re-encoding would only lose quality.
+            return bytes(data)
+        img = img.convert("RGB")
+        img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        buffered = BytesIO()
+        img.save(buffered, format="JPEG", quality=self.quality)
+        out = buffered.getvalue()
+        if is_jpeg and scale < 1.25 and len(out) >= len(data):
+            # Barely over the limit and already more compressed than our
+            # re-encode: the original is the cheaper upload.
+            return bytes(data)
+        return out
+
+    def get(self, data):
+        path = self._path(data)
+        self.bytes_in += len(data)
+        if os.path.exists(path):
+            self.hits += 1
+            with open(path, "rb") as f:
+                out = f.read()
+        else:
+            self.misses += 1
+            out = self._resize(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(out)
+            os.replace(tmp_path, path)
+        self.bytes_out += len(out)
+        return out
+
+    def warm(self, images, workers=8):
+        # Preprocessing stage: resize a batch of source images in parallel.
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(self.get, images):
+                pass
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "errors": self.errors
+        }
+
+
+if __name__ == "__main__":
+    from image_pack import iter_metadata, read_image_bytes
+
+    parser = argparse.ArgumentParser(
+        description="Pre-compute the downscaled VL images for Data/data_image.")
+    parser.add_argument("--data_image", type=str, default="Data/data_image")
+    parser.add_argument("--cache_dir", type=str, default="cache/vl_images")
+    parser.add_argument("--max_side", type=int, default=1536)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    cache = ResizedImageCache(args.cache_dir, args.max_side, args.quality)
+    images = (read_image_bytes(img_info, base_dir)
+              for sample, base_dir in iter_metadata(args.data_image)
+              for img_info in sample.get("image_info", []))
+    cache.warm((data for data in images if data), args.workers)
+    print(cache.stats())
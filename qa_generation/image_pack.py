@@ -0,0 +1,156 @@
+import argparse
+import base64
+import glob
+import json
+import mmap
+import os
+
+# Binary image pack: all image bytes concatenated into `<prefix>.bin` plus a
+# small `<prefix>.idx.json` mapping original_sample_index -> [[offset, length],
+# ...] in image order (image_index 1 is the first entry). The blob is read via
+# mmap, so opening a pack is cheap and only the images that are actually used
+# are paged in.
+
+
+class ImagePack:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(f"{prefix}.idx.json", 'r', encoding='utf-8') as f:
+            self.index = json.load(f)["images"]
+        self._file = open(f"{prefix}.bin", 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+        else:
+            self._mm = None
+            self._view = memoryview(b"")
+
+    def __contains__(self, sample_index):
+        return str(sample_index) in self.index
+
+    def num_images(self, sample_index):
+        return len(self.index.get(str(sample_index), []))
+
+    def get_bytes(self, sample_index, image_index):
+        # Zero-copy view into the mapped blob; image_index is 1-based.
+        entries = self.index.get(str(sample_index))
+        if not entries or not 1 <= image_index <= len(entries):
+            return None
+        offset, length = entries[image_index - 1]
+        if not length:
+            return None
+        return self._view[offset:offset + length]
+
+    def get_base64(self, sample_index, image_index):
+        data = self.get_bytes(sample_index, image_index)
+        if data is None:
+            return None
+        return base64.b64encode(data).decode('utf-8')
+
+    def close(self):
+        self._view.release()
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+
+class ImagePackWriter:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        self.index = {}
+        self._file = open(f"{prefix}.bin", 'wb')
+        self._offset = 0
+
+    def add(self, sample_index, data):
+        self.index.setdefault(str(sample_index), []).append(
+            [self._offset, len(data)])
+        self._file.write(data)
+        self._offset += len(data)
+
+    def add_missing(self, sample_index):
+        # Keeps image positions aligned when an image has no data.
+        self.index.setdefault(str(sample_index), []).append([0, 0])
+
+    def close(self):
+        self._file.close()
+        with open(f"{self.prefix}.idx.json", 'w', encoding='utf-8') as f:
+            json.dump({"version": 1, "images": self.index}, f)
+
+
+def read_image_bytes(img_info, base_dir=None):
+    # The inline base64 is what the pipeline has always sent, so it wins over
+    # the file on disk.
+    if img_info.get("image_base64"):
+        return base64.b64decode(img_info["image_base64"])
+    for path in (img_info.get("local_path"),
+                 os.path.join(base_dir, img_info["image_name"])
+                 if base_dir and img_info.get("image_name") else None):
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+    return None
+
+
+def iter_metadata(data_image_dir):
+    pattern = os.path.join(data_image_dir, "item_*", "metadata_*.json")
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield json.load(f), os.path.dirname(path)
+
+
+def convert(samples, prefix, slim_metadata_path=None):
+    # `samples` yields (metadata dict, directory holding its image files).
+    writer = ImagePackWriter(prefix)
+    slim = {}
+    num_images = 0
+    for sample, base_dir in samples:
+        oid = sample["original_sample_index"]
+        for img_info in sample.get("image_info", []):
+            data = read_image_bytes(img_info, base_dir)
+            if data is None:
+                writer.add_missing(oid)
+            else:
+                writer.add(oid, data)
+                num_images += 1
+        if slim_metadata_path:
+            slim_sample = dict(sample)
+            slim_sample["image_info"] = [{
+                k: v
+                for k, v in img_info.items() if k != "image_base64"
+            } for img_info in sample.get("image_info", [])]
+            slim[str(oid)] = slim_sample
+    writer.close()
+    if slim_metadata_path:
+        with open(slim_metadata_path, 'w', encoding='utf-8') as f:
+            json.dump(slim, f, ensure_ascii=False)
+    return len(writer.index), num_images
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build an image pack from Data/data_image or from a "
+        "combined metadata JSON (original_sample_index -> metadata).")
+    parser.add_argument("--data_image", type=str, default=None)
+    parser.add_argument("--metadata_json", type=str, default=None)
+    parser.add_argument("--out", type=str, default="Data/image_pack")
+    parser.add_argument("--slim_metadata",
+                        type=str,
+                        default=None,
+                        help="also write the metadata without image_base64")
+    args = parser.parse_args()
+
+    if args.metadata_json:
+        with open(args.metadata_json, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        samples = ((dict(m, original_sample_index=m.get(
+            "original_sample_index", k)), None) for k, m in metadata.items())
+    else:
+        samples = iter_metadata(args.data_image or "Data/data_image")
+
+    n_samples, n_images = convert(samples, args.out, args.slim_metadata)
+    print(f"Packed {n_images} images of {n_samples} samples into "
+          f"{args.out}.bin / {args.out}.idx.json")
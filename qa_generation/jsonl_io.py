@@ -0,0 +1,63 @@
+import json
+import os
+import textwrap
+
+# Per-stage JSONL outputs. Every finished sample is appended as one line as
+# soon as it completes; only (order key, file offset) pairs stay in memory,
+# which is enough to export the classic indented JSON array in input order
+# afterwards and to stream the records into the next stage.
+
+
+class JsonlWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = []
+        self._file = open(path, 'wb')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def write(self, record, order_key=0):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self.write_line(line.encode("utf-8"), order_key)
+
+    def write_line(self, line, order_key=0):
+        # `line` is one already serialised record, as bytes.
+        self.offsets.append((order_key, self._file.tell()))
+        self._file.write(line if line.endswith(b"\n") else line + b"\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def export_json(self, path):
+        # Same layout as json.dump(records, f, indent=2), written one record
+        # at a time in order_key order.
+        with open(self.path, 'rb') as src, open(path, 'w',
+                                                encoding='utf-8') as dst:
+            if not self.offsets:
+                dst.write("[]")
+                return
+            dst.write("[\n")
+            for i, (_, offset) in enumerate(sorted(self.offsets)):
+                src.seek(offset)
+                record = json.loads(src.readline())
+                if i:
+                    dst.write(",\n")
+                dst.write(
+                    textwrap.indent(
+                        json.dumps(record, indent=2, ensure_ascii=False),
+                        "  "))
+            dst.write("\n]")
+
+
+def jsonl_path(path):
+    return os.path.splitext(path)[0] + ".jsonl"
+
+
+def iter_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Opt-in on-disk cache for chat completion responses. Requests are keyed by a
+# hash of (model, messages, temperature, max_tokens) plus the constrained
+# decoding parameters, if any; entries expire after a TTL and the least
+# recently used ones are evicted once the cache grows past its size budget.
+# Shard processes may share one cache file: writers wait up to
+# BUSY_TIMEOUT_SECONDS for a lock, and a cache that stays locked (or fails
+# otherwise) only costs a miss or a lost write, never the response. Async
+# callers use aget / aput, which run the SQLite calls in a worker thread so
+# waiting for a lock never stalls the event loop.
+
+BUSY_TIMEOUT_SECONDS = 5.0
+
+
+def request_key(request):
+    payload = {
+        k: request.get(k)
+        for k in ("model", "messages", "temperature", "max_tokens")
+    }
+    # Only when set, so keys of plain requests stay as they were.
+    for k in ("response_format", "extra_body"):
+        if request.get(k) is not None:
+            payload[k] = request[k]
+    blob = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, path, max_bytes=None, ttl_seconds=None, bypass=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # With bypass on, lookups always miss but fresh responses are still
+        # written, which refreshes stale entries.
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.db_errors = 0
+        self._puts_since_evict = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Used from worker threads (aget / aput), one at a time.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,
+                                   timeout=BUSY_TIMEOUT_SECONDS,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, created REAL NOT NULL, "
+                         "accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed "
+                         "ON responses (accessed)")
+        self.evict()
+
+    async def aget(self, request):
+        return await asyncio.to_thread(self.get, request)
+
+    async def aput(self, request, value):
+        await asyncio.to_thread(self.put, request, value)
+
+    def get(self, request):
+        with self._lock:
+            return self._get(request)
+
+    def put(self, request, value):
+        with self._lock:
+            self._put(request, value)
+
+    def _get(self, request):
+        if self.bypass:
+            self.misses += 1
+            return None
+        key = request_key(request)
+        try:
+            row = self._db.execute(
+                "SELECT value, created FROM responses WHERE key = ?",
+                (key, )).fetchone()
+        except sqlite3.Error:
+            self._on_db_error()
+            row = None
+        now = time.time()
+        if row is None or (self.ttl_seconds
+                           and now - row[1] > self.ttl_seconds):
+            self.misses += 1
+            return None
+        try:
+            self._db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        except sqlite3.Error:
+            # Only the LRU order suffers; the hit is still good.
+            self._on_db_error()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def _put(self, request, value):
+        blob = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (request_key(request), blob, len(blob), now, now))
+            self._db.commit()
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= 256:
+                self.evict()
+        except sqlite3.Error:
+            self._on_db_error()
+
+    def _on_db_error(self):
+        self.db_errors += 1
+        try:
+            self._db.rollback()
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        self._puts_since_evict = 0
+        if self.ttl_seconds:
+            self._db.execute("DELETE FROM responses WHERE created < ?",
+                             (time.time() - self.ttl_seconds, ))
+        if self.max_bytes:
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Drop least recently used entries until we are back under
+                # 90% of the budget.
+                excess = total - int(self.max_bytes * 0.9)
+                rows = self._db.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed")
+                doomed = []
+                for key, size in rows:
+                    if excess <= 0:
+                        break
+                    doomed.append((key, ))
+                    excess -= size
+                self._db.executemany("DELETE FROM responses WHERE key = ?",
+                                     doomed)
+        self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) "
+                "FROM responses").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": size,
+            "db_errors": self.db_errors
+        }
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import zlib
+
+# Cheap local first pass for Step 0: an L2-regularised logistic regression
+# over TF-IDF weighted unigram/bigram features of the sample text and
+# captions, trained on earlier Step 0 verdicts of the LLM. Samples scored
+# below `negative_below` or above `positive_above` are decided locally; only
+# the band in between is sent to the LLM classifier. NumPy is only needed for
+# training.
+
+TOKEN_RE = re.compile(r"[a-z][a-z0-9\-]+")
+
+
+def sample_text(sample):
+    # Same context the LLM judge sees, plus the image captions.
+    text = sample.get("back_info", "")
+    if not text:
+        text = " ".join(
+            t for t in sample.get("text_list", []) if isinstance(t, str))
+    captions = [
+        img.get("caption", "")
+        for img in sample.get("image_info") or sample.get("image_captions", [])
+    ]
+    return " ".join([text] + [c for c in captions if isinstance(c, str)])
+
+
+def features(text):
+    tokens = TOKEN_RE.findall(text.lower())
+    feats = set(tokens)
+    feats.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    return feats
+
+
+def train(feature_sets,
+          labels,
+          min_df=2,
+          max_features=50000,
+          l2=1e-4,
+          steps=300,
+          lr=0.1):
+    import numpy as np
+
+    df = {}
+    for feats in feature_sets:
+        for f in feats:
+            df[f] = df.get(f, 0) + 1
+    vocab = sorted((f for f, n in df.items() if n >= min_df),
+                   key=lambda f: -df[f])[:max_features]
+    column = {f: i for i, f in enumerate(vocab)}
+    n = len(feature_sets)
+    idf = np.array([math.log((1 + n) / (1 + df[f])) + 1 for f in vocab])
+
+    # Sparse rows as (row, column, value) triplets, L2-normalised per sample.
+    rows, cols, vals = [], [], []
+    for r, feats in enumerate(feature_sets):
+        idx = [column[f] for f in feats if f in column]
+        if not idx:
+            continue
+        v = idf[idx]
+        rows.extend([r] * len(idx))
+        cols.extend(idx)
+        vals.extend(v / np.sqrt((v * v).sum()))
+    rows, cols, vals = np.array(rows), np.array(cols), np.array(vals)
+    y = np.array(labels, dtype=float)
+
+    # Full-batch Adam on the mean log loss.
+    w = np.zeros(len(vocab))
+    b = 0.0
+    m = np.zeros(len(vocab) + 1)
+    v2 = np.zeros(len(vocab) + 1)
+    for t in range(1, steps + 1):
+        z = np.bincount(rows, weights=vals * w[cols], minlength=n) + b
+        residual = 1.0 / (1.0 + np.exp(-np.clip(z, -50, 50))) - y
+        grad_w = np.bincount(cols,
+                             weights=vals * residual[rows],
+                             minlength=len(vocab)) / n + l2 * w
+        grad = np.append(grad_w, residual.mean())
+        m = 0.9 * m + 0.1 * grad
+        v2 = 0.999 * v2 + 0.001 * grad * grad
+        step = lr * (m / (1 - 0.9**t)) / (np.sqrt(v2 / (1 - 0.999**t)) + 1e-8)
+        w -= step[:-1]
+        b -= step[-1]
+    return {
+        "weights": {f: float(w[i]) for i, f in enumerate(vocab)},
+        "idf": {f: float(idf[i]) for i, f in enumerate(vocab)},
+        "bias": float(b)
+    }
+
+
+class Prefilter:
+
+    def __init__(self, model, negative_below=0.02, positive_above=0.98):
+        self.model = model
+        self.weights = model["weights"]
+        self.idf = model["idf"]
+        self.bias = model["bias"]
+        self.negative_below = negative_below
+        self.positive_above = positive_above
+        self.positives = 0
+        self.negatives = 0
+        self.uncertain = 0
+
+    @classmethod
+    def load(cls, path, negative_below=0.02, positive_above=0.98):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f), negative_below, positive_above)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(dict(self.model, version=1), f, ensure_ascii=False)
+
+    def fingerprint(self):
+        # Changes whenever the model or the band does, so Step 0 checkpoints
+        # made with other settings are not reused.
+        blob = json.dumps(
+            [self.model, self.negative_below, self.positive_above],
+            sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
+
+    def probability_of(self, feats):
+        known = [f for f in feats if f in self.idf]
+        norm = math.sqrt(sum(self.idf[f]**2 for f in known)) or 1.0
+        score = self.bias + sum(self.weights[f] * self.idf[f]
+                                for f in known) / norm
+        score = max(-50.0, min(50.0, score))
+        return 1.0 / (1.0 + math.exp(-score))
+
+    def probability(self, sample):
+        return self.probability_of(features(sample_text(sample)))
+
+    def decide(self, sample):
+        # True / False when confident, None when the LLM has to decide.
+        p = self.probability(sample)
+        if p < self.negative_below:
+            self.negatives += 1
+            return False
+        if p > self.positive_above:
+            self.positives += 1
+            return True
+        self.uncertain += 1
+        return None
+
+    def stats(self):
+        total = self.positives + self.negatives + self.uncertain
+        return {
+            "positives": self.positives,
+            "negatives": self.negatives,
+            "sent_to_llm": self.uncertain,
+            "skip_rate": (self.positives + self.negatives) / total
+            if total else 0.0
+        }
+
+
+class LabelLog:
+    # Append-only record of the Step 0 verdicts that came from the LLM; the
+    # training data for the prefilter. Local decisions are never logged, so
+    # the model is not trained on its own output.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def add(self, oid, is_biomedical):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(
+            json.dumps({
+                "original_sample_index": oid,
+                "is_biomedical": bool(is_biomedical)
+            }) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def load_labels(label_files=(), checkpoint_file=None):
+    # {str(original_sample_index): bool}. Step 0 records of a checkpoint store
+    # written without the prefilter are LLM verdicts as well: a stored None
+    # means filtered out, a stored sample means kept.
+    labels = {}
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if rec.get("stage") == "step0":
+                    labels[str(rec["original_sample_index"])] = (
+                        rec["result"] is not None)
+    for path in label_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    labels[str(rec["original_sample_index"])] = bool(
+                        rec["is_biomedical"])
+    return labels
+
+
+def is_holdout(oid, holdout_percent):
+    return zlib.crc32(str(oid).encode("utf-8")) % 100 < holdout_percent
+
+
+def report(model, feature_sets, labels):
+    # Precision/recall of the local decisions against the LLM labels.
+    # Everything in the band goes to the LLM and is counted as correct.
+    tp = fp = fn = 0
+    auto_pos = auto_pos_ok = auto_neg = auto_neg_ok = 0
+    for feats, label in zip(feature_sets, labels):
+        p = model.probability_of(feats)
+        if p > model.positive_above:
+            auto_pos += 1
+            auto_pos_ok += label
+            pred = True
+        elif p < model.negative_below:
+            auto_neg += 1
+            auto_neg_ok += not label
+            pred = False
+        else:
+            pred = label
+        tp += pred and label
+        fp += pred and not label
+        fn += (not pred) and label
+    n = len(labels)
+    return {
+        "samples": n,
+        "skip_rate": (auto_pos + auto_neg) / n if n else 0.0,
+        "auto_positive": auto_pos,
+        "auto_positive_precision": auto_pos_ok / auto_pos if auto_pos else 1.0,
+        "auto_negative": auto_neg,
+        "auto_negative_precision": auto_neg_ok / auto_neg if auto_neg else 1.0,
+        "precision": tp / (tp + fp) if tp + fp else 1.0,
+        "recall": tp / (tp + fn) if tp + fn else 1.0
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train the Step 0 prefilter on earlier LLM verdicts and "
+        "report precision/recall of the local decisions on a holdout split.")
+    parser.add_argument("--input", type=str, required=True,
+                        help="raw samples (the pipeline's INPUT_SOURCE_FILE)")
+    parser.add_argument("--labels", type=str, nargs="*", default=[],
+                        help="label logs written by the pipeline")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="checkpoint store of runs without the prefilter")
+    parser.add_argument("--out", type=str, default="prefilter_model.json")
+    parser.add_argument("--negative_below", type=float, default=0.02)
+    parser.add_argument("--positive_above", type=float, default=0.98)
+    parser.add_argument("--holdout_percent", type=int, default=20)
+    parser.add_argument("--min_df", type=int, default=2)
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels, args.checkpoint)
+    from corpus_reader import Corpus
+
+    # Only the feature sets are kept, not the samples (with their images).
+    train_x, train_y, test_x, test_y = [], [], [], []
+    for s in Corpus(args.input):
+        oid = s.get("original_sample_index")
+        if str(oid) not in labels:
+            continue
+        x, y = (test_x, test_y) if is_holdout(
+            oid, args.holdout_percent) else (train_x, train_y)
+        x.append(features(sample_text(s)))
+        y.append(labels[str(oid)])
+    print(f"{len(train_y) + len(test_y)} labelled samples, "
+          f"{sum(train_y) + sum(test_y)} biomedical")
+
+    model = Prefilter(train(train_x, train_y, min_df=args.min_df),
+                      args.negative_below, args.positive_above)
+    print("Holdout:", json.dumps(report(model, test_x, test_y), indent=2))
+
+    # The saved model uses every labelled sample.
+    model = Prefilter(
+        train(train_x + test_x, train_y + test_y, min_df=args.min_df))
+    model.save(args.out)
+    print(f"Saved {len(model.weights)} features to {args.out}")
@@ -1,11 +1,30 @@
+import argparse
 import asyncio
 import json
 import os
 import base64
 import re
+import subprocess
+import sys
 import time
-from tqdm.asyncio import tqdm_asyncio
-from openai import AsyncOpenAI, APIConnectionError, InternalServerError
+from collections import namedtuple
+from functools import lru_cache
+from tqdm import tqdm
+from email.utils import parsedate_to_datetime
+from openai import (AsyncOpenAI, APIConnectionError, APITimeoutError,
+                    BadRequestError, InternalServerError, RateLimitError)
+from batching import MicroBatcher
+from checkpoint_store import CheckpointStore, stage_fingerprint
+from corpus_reader import Corpus
+from image_cache import ResizedImageCache
+from image_pack import ImagePack
+from jsonl_io import JsonlWriter, iter_jsonl, jsonl_path
+from llm_cache import ResponseCache
+from prefilter import LabelLog, Prefilter
+from rate_limit import EndpointLimiter, RetryPolicy
+from sharding import (merge_jsonl, parse_shard, scale_limits, shard_of,
+                      shard_path)
+from structured_output import ParseError, ParseStats, parse_structured
 
 # ================= CONFIGURATION =================
 DASH_API_KEY = os.getenv("DASHSCOPE_API_KEY") or "your_key_here"
@@ -14,18 +33,256 @@ LOCAL_VL_BASE_URL = "xxx"
 LOCAL_TEXT_API_KEY = "xxx"
 LOCAL_TEXT_BASE_URL = "xxx"
 
+# The `data_final` file corresponds to the data in `qa_generation_quickly.json`, and contains only filtered biomedical data. If you want to see the results of the first filtering step, you can use `source_data.json`, which includes non-biomedical data.
+INPUT_SOURCE_FILE = 'Data\qa_generation_quickly.json'
+FINAL_OUTPUT = "final_qa_dataset.json"
+
+# "barrier": every sample finishes a step before the next step starts.
+# "streaming": samples flow through the steps independently via bounded queues.
+# In both modes every step appends its finished samples to a JSONL file next
+# to its output file (e.g. step0_filtered.jsonl, final_qa_dataset.jsonl) as
+# soon as they complete.
+PIPELINE_MODE = "barrier"
+BARRIER_STAGE_WORKERS = 256  # concurrent samples per step in barrier mode
+STREAM_STAGE_WORKERS = 16  # concurrent samples per stage
+STREAM_QUEUE_SIZE = 64  # max samples waiting between two stages
+# Set by `--shard i/N`: this process only runs the samples of shard i and
+# writes its own `*.shard-i-of-N.*` outputs, checkpoint and label log. With
+# SHARD_SPLIT_LIMITS each shard gets 1/N of the endpoint limits below, as all
+# shards share the same endpoints.
+SHARD = None
+SHARD_SPLIT_LIMITS = True
+# Also write each step's classic indented JSON array (in input order) from its
+# JSONL once the step is done. This is a streaming conversion, not a dump of
+# an in-memory list.
+STAGE_JSON_EXPORT = True
+
+# Per-sample, per-stage results are appended here and reused on restart as long
+# as the stage's prompt template(s) and model are unchanged. Set to None to
+# disable checkpointing.
+CHECKPOINT_FILE = "pipeline_checkpoint.jsonl"
+
+# Opt-in on-disk cache of LLM/VLM responses, keyed by (model, messages,
+# temperature, max_tokens). Set RESPONSE_CACHE_FILE to enable it. With
+# RESPONSE_CACHE_BYPASS the cache is not read but fresh responses still
+# overwrite the stored ones.
+RESPONSE_CACHE_FILE = None  # e.g. "cache/llm_responses.sqlite"
+RESPONSE_CACHE_MAX_MB = 2048
+RESPONSE_CACHE_TTL_DAYS = 30
+RESPONSE_CACHE_BYPASS = False
+
+# Step 0 (biomedical filter) and Step 1 (keywords) can pack up to K samples
+# into one request that answers with a JSON array keyed by
+# original_sample_index; samples missing from the answer are retried one by
+# one. 1 = one request per sample. A batch is sent when K samples are waiting
+# or TEXT_BATCH_MAX_WAIT seconds after its first sample arrived. See
+# `python benchmark.py batching` for throughput against K.
+FILTER_BATCH_SIZE = 1
+KEYWORD_BATCH_SIZE = 1
+TEXT_BATCH_MAX_WAIT = 0.2
+
+# Optional local prefilter for Step 0, trained on earlier LLM verdicts with
+# `python prefilter.py --input ... --labels step0_labels.jsonl`. Samples it
+# scores below PREFILTER_NEGATIVE_BELOW or above PREFILTER_POSITIVE_ABOVE skip
+# the LLM; the rest are classified as before. Every verdict the LLM gives is
+# appended to PREFILTER_LABELS_FILE as training data for the next model.
+PREFILTER_MODEL_FILE = None  # e.g. "prefilter_model.json"
+PREFILTER_NEGATIVE_BELOW = 0.02
+PREFILTER_POSITIVE_ABOVE = 0.98
+PREFILTER_LABELS_FILE = "step0_labels.jsonl"
+
+# Send the static instructions of every text prompt as a system message and
+# the per-sample data last, so vLLM/SGLang prefix caching can reuse the
+# instruction tokens across samples. False keeps the original single user
+# message. See `python benchmark.py prefix-cache`.
+PROMPT_PREFIX_CACHING = True
+
+# JSON answers are parsed leniently (code fences, preambles, trailing commas
+# and truncated output are repaired locally) and checked against the stage's
+# entry in OUTPUT_SCHEMAS. Only answers that still fail are sent back to the
+# model with the error, at most this many times.
+PARSE_REPAIR_ATTEMPTS = 1
+
+# Constrained decoding of JSON answers on the text endpoint, with the stage's
+# schema from OUTPUT_SCHEMAS:
+#   "json_schema": response_format={"type": "json_schema", ...} (OpenAI API,
+#                  vLLM, SGLang)
+#   "guided_json": extra_body={"guided_json": schema} (older vLLM)
+#   "json_object": JSON mode without a schema (object answers only)
+#   None:          plain text, answers only go through the parser
+# An endpoint that rejects the parameter gets plain requests for the rest of
+# the run. While enabled, pure format reminders are cut from the prompts
+# (FORMAT_REMINDER_RE); answers are still parsed and validated either way.
+TEXT_STRUCTURED_DECODING = "json_schema"
+
+# Per-endpoint limits. The concurrency window starts at `initial_concurrency`
+# and adapts AIMD-style: +1 per window of fast successful requests, halved on
+# errors or when a request takes longer than `target_latency` seconds.
+# `requests_per_second` / `tokens_per_second` are optional token-bucket budgets
+# (None = unlimited).
+TEXT_ENDPOINT_LIMITS = {
+    "max_concurrency": 128,
+    "min_concurrency": 4,
+    "initial_concurrency": 32,
+    "requests_per_second": None,
+    "tokens_per_second": None,
+    "target_latency": 90.0
+}
+VL_ENDPOINT_LIMITS = {
+    "max_concurrency": 32,
+    "min_concurrency": 2,
+    "initial_concurrency": 10,
+    "requests_per_second": None,
+    "tokens_per_second": None,
+    "target_latency": 60.0
+}
+# Rough prompt-size estimate used by the tokens/s budget before real usage is
+# known.
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 1024
+
+# Batch stages never look at partial output, so requests are non-streaming by
+# default. Set to True to stream (e.g. for very long generations behind a proxy
+# that times out idle connections).
+STREAM_RESPONSES = False
+
+# Retries of rate-limit (429), timeout, connection and 5xx errors: exponential
+# backoff with full jitter, honouring Retry-After, capped by a per-run budget
+# (each request adds `budget_ratio` retries on top of `budget_min`).
+RETRY_POLICY = {
+    "base_delay": 1.0,
+    "max_delay": 60.0,
+    "budget_ratio": 0.2,
+    "budget_min": 50
+}
+
+# Optional image pack built with `python image_pack.py` (prefix of the
+# .bin/.idx.json pair). When set, images are read lazily from the mmap'ed pack
+# instead of the inline `image_base64` strings.
+IMAGE_PACK_PREFIX = None  # e.g. "Data/image_pack"
+
+# Images sent to VL models are downscaled so their longest side is at most
+# VL_IMAGE_MAX_SIDE and re-encoded as JPEG. Results are cached on disk keyed by
+# the source image hash (pre-compute them with `python image_cache.py`). Set
+# VL_IMAGE_CACHE_DIR to None to send the original bytes.
+VL_IMAGE_CACHE_DIR = "cache/vl_images"
+VL_IMAGE_MAX_SIDE = 1536
+VL_IMAGE_JPEG_QUALITY = 85
+
+# Images of one sample are described concurrently. With VL_MULTI_IMAGE_REQUEST
+# a multi-image sample is instead sent as a single request (only for models
+# that accept several images per request); samples whose answer cannot be
+# parsed fall back to one request per image.
+VL_MULTI_IMAGE_REQUEST = False
+
 # 模型名称
 VL_MODEL_NAME = "qwen3_vl_235b_instruct"
 TEXT_MODEL_NAME = "qwen3_235b_instruct"
 
+# VL models queried in Step 2b; the consensus step merges their descriptions.
+# Entries without a `base_url` use local_vl_client / VL_ENDPOINT_LIMITS. Each
+# model gets its own client, limiter and per-sample `timeout` (seconds, None =
+# no limit), so a slow model cannot stall a sample. Responses share the
+# response cache, whose key includes the model name.
+VL_MODELS = {
+    "qwenvl": {
+        "display_name": "QwenVL",
+        "model": VL_MODEL_NAME,
+        "timeout": 600
+    },
+    # "fleming": {
+    #     "display_name": "Fleming",
+    #     "model": "fleming_vl_38b",
+    #     "api_key": "xxx",
+    #     "base_url": "xxx",
+    #     "limits": VL_ENDPOINT_LIMITS,
+    #     "timeout": 600
+    # },
+    # "hulu": {"display_name": "Hulu", "model": "hulu_med_32b", ...},
+    # "lingshu": {"display_name": "Lingshu", "model": "lingshu_32b", ...},
+}
+# Name used for single-model results from runs before VL_MODELS existed.
+VL_CONSENSUS_FALLBACK_NAME = "qwenvl"
+# Images with fewer than two usable descriptions skip the consensus call. With
+# CONSENSUS_BATCH the remaining images of a sample are merged in one JSON
+# request instead of one request per image.
+CONSENSUS_BATCH = True
+
+# Step 7: automated QC of the final QA pairs with LOGIC_CHAIN_QC_1/2/3 (chain
+# coherence, grounding of the visual phenomena, question/conclusion
+# alignment). A sample passes a check when every listed score reaches its
+# minimum (scores are 1-5); samples passing all three are written to
+# QC_OUTPUT, which then becomes the final output of the run (the unchecked
+# QA pairs stay in the Step 6 file). Costs up to three extra LLM calls per
+# sample. With QC_FIRST_CHECK_GATES, QC2/QC3 are only sent after QC1 passed;
+# without it all three go out at once (lower latency per sample, but a
+# cancelled request still costs its tokens on the server).
+RUN_QC = True
+QC_OUTPUT = "final_qa_dataset_qc.json"
+QC_THRESHOLDS = {
+    "qc1": {
+        "Evidence Support Strength": 4,
+        "Logical Flow and Coherence": 4
+    },
+    "qc2": {
+        "Source Grounding & Verification": 4
+    },
+    "qc3": {
+        "Question-Conclusion Alignment": 4,
+        "Scale/Legend Consistency Check": 4,
+        "Reasoning Validity": 4
+    }
+}
+QC_FIRST_CHECK_GATES = True
+
 # 初始化客户端
+# Retries are handled by `retry_policy` below, so the SDK's own are disabled.
 local_vl_client = AsyncOpenAI(api_key=LOCAL_VL_API_KEY,
                               base_url=LOCAL_VL_BASE_URL,
-                              timeout=120.0)
+                              timeout=120.0,
+                              max_retries=0)
 
 local_text_client = AsyncOpenAI(api_key=LOCAL_TEXT_API_KEY,
                                 base_url=LOCAL_TEXT_BASE_URL,
-                                timeout=120.0)
+                                timeout=120.0,
+                                max_retries=0)
+
+# Retried, and halve the concurrency window of the endpoint's limiter.
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError,
+                    InternalServerError, asyncio.TimeoutError)
+
+text_limiter = EndpointLimiter("text",
+                               overload_errors=RETRYABLE_ERRORS,
+                               **TEXT_ENDPOINT_LIMITS)
+vl_limiter = EndpointLimiter("vl",
+                             overload_errors=RETRYABLE_ERRORS,
+                             **VL_ENDPOINT_LIMITS)
+retry_policy = RetryPolicy(**RETRY_POLICY)
+# Per-model token and latency totals for cost/throughput accounting.
+usage_totals = {}
+# Per-stage outcomes of parsing the JSON answers (ok / repaired locally /
+# re-prompted / failed).
+parse_stats = ParseStats()
+# Step 7 outcomes: passed, failed_<check> (first failing check) or
+# incomplete (sample lacks the question or logic chain to check).
+qc_stats = {}
+
+image_pack = ImagePack(IMAGE_PACK_PREFIX) if IMAGE_PACK_PREFIX else None
+vl_image_cache = ResizedImageCache(
+    VL_IMAGE_CACHE_DIR, VL_IMAGE_MAX_SIDE,
+    VL_IMAGE_JPEG_QUALITY) if VL_IMAGE_CACHE_DIR else None
+
+prefilter = Prefilter.load(
+    PREFILTER_MODEL_FILE, PREFILTER_NEGATIVE_BELOW,
+    PREFILTER_POSITIVE_ABOVE) if PREFILTER_MODEL_FILE else None
+step0_labels = LabelLog(
+    PREFILTER_LABELS_FILE) if PREFILTER_LABELS_FILE else None
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_FILE,
+    max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+    ttl_seconds=RESPONSE_CACHE_TTL_DAYS * 24 * 3600,
+    bypass=RESPONSE_CACHE_BYPASS) if RESPONSE_CACHE_FILE else None
 
 # ================= PROMPT DEFINITIONS (PASTE YOUR PROMPTS HERE) =================
 
@@ -40,6 +297,17 @@ Return ONLY a JSON object with a single boolean field `is_biomedical`.
 Example: {{"is_biomedical": true}} or {{"is_biomedical": false}}
 """
 
+BIOMED_CHECK_BATCH_PROMPT = """
+You are a data classifier. For each input item below, determine if its text context describes Biomedical, Medical, or Clinical content (e.g., pathology, anatomy, cell biology, medical imaging, clinical reports). Judge every item independently.
+
+Input Items:
+{items}
+
+Output Requirement:
+Return ONLY a JSON array with one object per input item, each with the item's integer `original_sample_index` and a single boolean field `is_biomedical`.
+Example: [{{"original_sample_index": 12, "is_biomedical": true}}, {{"original_sample_index": 31, "is_biomedical": false}}]
+"""
+
 BACKGROUND_DISTILLATION_PROMPT_TEMPLATE = """
 As an expert biomedically scientific editor, your task is to distill the provided [Background] text into a concise, focusing on biomedical entity information.
 
@@ -97,6 +365,43 @@ Output *only* the result in the following exact structure:
 [Main Category Name]: keyword1, keyword2, keyword3, ..., keyword15
 """
 
+KEYWORD_Category_BATCH_PROMPT_TEMPLATE = """
+You are a top-tier biomedical research analyst, skilled at structured information extraction and thematic classification. You will receive several independent items, each with its own [Context] and [Image_caption]. Perform the two-step analysis below on EACH item separately; never mix information between items.
+
+I. INPUT DATA
+
+{items}
+
+*(Note: A [Context] may contain `[Image]` tokens indicating image positions. You CANNOT see these images; you MUST rely *only* on the text for all visual details.)*
+
+II. STEP 1: THEMATIC CLASSIFICATION
+For each item, select **ONE** Main Category that best describes its core research domain. Use the professional framework below.
+
+CLASSIFICATION FRAMEWORK:
+- Basic Medical Science :
+  Focuses on the fundamental mechanisms of life and disease.
+  (Keywords: Molecular biology, genetics, biochemistry, immunology, physiology, anatomy, neurosciences, cellular pathways, pathogenesis models).
+- Clinical Medicine :
+  Focuses on the diagnosis, treatment, and management of human diseases in patients.
+  (Keywords: Specific diseases (e.g., Heart Disease, Endocarditis), surgical procedures, patient case studies, treatment outcomes, clinical neurology, ophthalmology, urology, orthopaedics).
+- Diagnostics & Laboratory Medicine :
+  Focuses on the methods and technologies used to detect and diagnose diseases.
+  (Keywords: Pathology, histopathology, cytopathology, medical imaging (Radiology, MRI, CT), biomarkers, lab tests, assay development, neuropathology, forensic analysis, electrocardiorgraphy).
+- Pharmacy & Therapeutics :
+  Focuses on the discovery, development, and application of drugs.
+  (Keywords: Pharmacology, drug synthesis, medicinal chemistry, drug targets, therapeutic strategies, drug resistance, clinical trials for drugs, pharmaceutical sciences).
+
+III. STEP 2: THEME-GUIDED KEYWORD EXTRACTION
+For each item, based on its [Context] and [Image_caption] as well as its classification result from STEP 1, extract a list of 10-15 highly specific biological or medical keywords.
+- **CRITICAL:** Ensure keywords are directly relevant to the selected Main Category.
+- **Focus on:** Specific protein/gene names, cell types/morphologies, disease names, diagnostic criteria (e.g., grading), specific drugs, or key experimental findings.
+- **Avoid:** Generic words or phrases.
+
+IV. REQUIRED OUTPUT FORMAT
+Return ONLY a JSON array with one object per input item, each with the item's integer `original_sample_index` and a `keywords` string in the exact structure "[Main Category Name]: keyword1, keyword2, keyword3, ..., keyword15":
+[{{"original_sample_index": 12, "keywords": "[Clinical Medicine]: keyword1, keyword2, ..."}}]
+"""
+
 VLM_PROMPT_TEMPLATE = """
 You are an expert biologist and biomedical researcher. You will be given a image and [Image Captions].Your task is to describe the visual content of the image. 
 
@@ -113,6 +418,25 @@ Provide A detailed description of the visual features present in the image,  gro
 - Output ONLY the description paragraph.
 """
 
+VLM_MULTI_IMAGE_PROMPT_TEMPLATE = """
+You are an expert biologist and biomedical researcher. You will be given {num_images} images, in order, and their [Image Captions]. Your task is to describe the visual content of each image.
+
+# Input Data
+[Image Captions]:
+{captions}
+
+# Task
+For each image, provide a detailed description of the visual features present in that image, grounded in its caption. Avoid using any conclusive statements. Focus on the observation of visual features in biomedical images.
+
+# Constraints
+- Each description is a single paragraph, not a list.
+- Do NOT mention "Image 1" or other image indices inside a description.
+
+# Output
+Return ONLY a JSON object with one key per image:
+{{"Image 1": "...", "Image 2": "...", ...}}
+"""
+
 CONSENSUS_PROMPT_TEMPLATE = """
 You are a senior biomedical image analyst. You are a senior biomedical image analyst. You will receive observations from four different biomedical experts regarding the same biomedical image.These observations may include their interpretations or inferences based on the image, which you should disregard.
 
@@ -123,17 +447,31 @@ You should limit yourself to purely visual descriptions, avoid adding any explan
 
 # Input Observations:
 
-[Model: Fleming]:
-{desc_fleming}
+{observations}
 
-[Model: Hulu]:
-{desc_hulu}
+# Key Requirements:
+1. Voting & Merging Strategy: 
+    - For overlapping features mentioned by multiple models, use **majority voting** to establish the **corroborated facts**.
+    - For distinct/unique details mentioned by only one model, **naturally merge** them into the description to enrich detail, provided they DO NOT contradict the **corroborated facts** or biomedical logic.
 
-[Model: Lingshu]:
-{desc_lingshu}
+2. Pure Observation: Describe ONLY the visible morphological features ( e.g. cells, staining, structures   ). Do not include any reasoning, such as "consistent with...", "indicates...", "seems to...", "suggests some expression...", "may represent...".  Focus on the visual features of the image itself; do not draw conclusions or inferences based on interpretations or deductions from the image.
+3. Integration: Output a single, coherent paragraph merging the corroborated facts and valid unique details naturally.
 
-[Model: QwenVL]:
-{desc_qwenvl}
+# Output
+(Output ONLY the Integration description paragraph.)
+"""
+
+CONSENSUS_BATCH_PROMPT_TEMPLATE = """
+You are a senior biomedical image analyst. For each image of the same biomedical figure, you will receive observations from several different biomedical experts. These observations may include their interpretations or inferences based on the image, which you should disregard.
+
+#Task:
+For EACH image separately, limit yourself to purely visual descriptions, avoid adding any explanatory logic, and extract the common visual information from that image's observations, while avoiding contradictions and ensuring the information is biomedically right. Generate a highly accurate comprehensive observation report per image.
+
+## Bad example:It combines Qwenvl's incorrect "cytoplasmic" description with a correct "prominent nuclear staining" description later,  resulting in a confusing and anatomically impossible description for a single stain.
+
+# Input Observations:
+
+{observations}
 
 # Key Requirements:
 1. Voting & Merging Strategy: 
@@ -141,10 +479,12 @@ You should limit yourself to purely visual descriptions, avoid adding any explan
     - For distinct/unique details mentioned by only one model, **naturally merge** them into the description to enrich detail, provided they DO NOT contradict the **corroborated facts** or biomedical logic.
 
 2. Pure Observation: Describe ONLY the visible morphological features ( e.g. cells, staining, structures   ). Do not include any reasoning, such as "consistent with...", "indicates...", "seems to...", "suggests some expression...", "may represent...".  Focus on the visual features of the image itself; do not draw conclusions or inferences based on interpretations or deductions from the image.
-3. Integration: Output a single, coherent paragraph merging the corroborated facts and valid unique details naturally.
+3. Integration: For each image, output a single, coherent paragraph merging the corroborated facts and valid unique details naturally.
+4. Separation: Never mix observations of different images.
 
 # Output
-(Output ONLY the Integration description paragraph.)
+Return ONLY a JSON object with one key per input image:
+{{"Image 1": "...", "Image 2": "..."}}
 """
 
 ENHANCED_CAPTION_PROMPT_TEMPLATE = """
@@ -203,9 +543,9 @@ Ensure the output is a valid JSON list of strings within the structure, correspo
 }}
 
 # Key Requirements
-1. JSON Validity: The output must be directly parseable by json.loads.
-2. Context Fidelity: Do not hallucinate details not present in the image or the text.
-3. Count Match: The number of keys in the dictionary must match the number of input images.
+1. Context Fidelity: Do not hallucinate details not present in the image or the text.
+2. Count Match: The number of keys in the dictionary must match the number of input images.
+3. JSON Validity: The output must be directly parseable by json.loads.
 
 Generate [Context-Enhanced Captions]: 
 """
@@ -553,9 +893,222 @@ You must return the result strictly in the following format:
 (Where A, B, C is an integer score from 1 to 5)
 """
 
+# Sent once, only when an answer cannot be parsed or does not match the
+# stage's schema; the broken answer is part of the conversation.
+JSON_REPAIR_PROMPT = """
+Your previous answer could not be used: {error}.
+Reply with ONLY the corrected JSON in the format requested above, keeping its content. No explanations and no code fences.
+"""
+
+# Expected shape of each stage's JSON answer (a JSON-Schema subset, see
+# structured_output.py). Answers that do not match are repaired or
+# re-prompted instead of silently dropping the sample.
+OUTPUT_SCHEMAS = {
+    "step0": {
+        "type": "object",
+        "required": ["is_biomedical"],
+        "properties": {
+            "is_biomedical": {
+                "type": "boolean"
+            }
+        }
+    },
+    "step0_batch": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "required": ["original_sample_index", "is_biomedical"],
+            "properties": {
+                "is_biomedical": {
+                    "type": "boolean"
+                }
+            }
+        }
+    },
+    "step1_batch": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "required": ["original_sample_index", "keywords"],
+            "properties": {
+                "keywords": {
+                    "type": "string"
+                }
+            }
+        }
+    },
+    "step3": {
+        "type": "object",
+        "required": ["Context_Enhanced_Captions"],
+        "properties": {
+            "Context_Enhanced_Captions": {
+                "type": "object",
+                "required": ["observations"],
+                "properties": {
+                    "observations": {
+                        "type": "object",
+                        "additionalProperties": {
+                            "type": "string"
+                        }
+                    }
+                }
+            }
+        }
+    },
+    "step4": {
+        "type": "array",
+        "minItems": 1,
+        "items": {
+            "type": "object",
+            "required": ["qa_pairs"],
+            "properties": {
+                "qa_pairs": {
+                    "type": "object",
+                    "additionalProperties": {
+                        "type": "object",
+                        "required": ["question", "answer"],
+                        "properties": {
+                            "question": {
+                                "type": "string"
+                            },
+                            "answer": {
+                                "type": "string"
+                            }
+                        }
+                    }
+                },
+                "image_indices": {
+                    "type": "array",
+                    "items": {
+                        "type": "integer"
+                    }
+                },
+                "biomedical_entities": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    }
+                }
+            }
+        }
+    },
+    "step5": {
+        "type": "array",
+        "minItems": 1,
+        "items": {
+            "type": "object",
+            "required": ["research_context", "experiments", "reasoning"],
+            "properties": {
+                "research_context": {
+                    "type": "string"
+                },
+                "experiments": {
+                    "type": "array",
+                    "items": {
+                        "type": "object"
+                    }
+                },
+                "reasoning": {
+                    "type": "object",
+                    "required": ["conclusion"],
+                    "properties": {
+                        "intermediate_inferences": {
+                            "type": "array"
+                        },
+                        "content": {
+                            "type": "string"
+                        },
+                        "conclusion": {
+                            "type": "string"
+                        }
+                    }
+                }
+            }
+        }
+    },
+    "step6": {
+        "type": "object",
+        "required": ["question", "answer"],
+        "properties": {
+            "explanation": {
+                "type": "string"
+            },
+            "question": {
+                "type": "string"
+            },
+            "answer": {
+                "type": "string"
+            }
+        }
+    },
+}
+
+
+def image_map_schema(image_indices):
+    # {"Image 1": "...", ...} answers of the multi-image VL and consensus
+    # batch prompts.
+    keys = [f"Image {idx}" for idx in image_indices]
+    return {
+        "type": "object",
+        "required": keys,
+        "properties": {key: {
+            "type": "string"
+        }
+                       for key in keys}
+    }
+
+
 # ================= UTILITY FUNCTIONS =================
 
 
+PLACEHOLDER_RE = re.compile(r"(?<!\{)\{(\w+)\}(?!\})")
+# Prompt lines that only insist on well-formed JSON. Redundant when the server
+# enforces the schema.
+FORMAT_REMINDER_RE = re.compile(
+    r"^(?:\d+\. JSON Validity:|Ensure the output is a valid JSON).*\n",
+    re.MULTILINE)
+# Clients that answered a constrained request with 400 Bad Request.
+structured_decoding_rejected = set()
+
+
+@lru_cache(maxsize=None)
+def split_prompt_template(template):
+    # Cut the input block out of a template: from the paragraph holding the
+    # first placeholder (plus a short "Input ..." heading paragraph right
+    # before it) to the end of the paragraph holding the last one. Returns
+    # the static instructions and the block, both still as templates.
+    placeholders = list(PLACEHOLDER_RE.finditer(template))
+    if not placeholders:
+        return template, ""
+    start = template.rfind("\n\n", 0, placeholders[0].start())
+    start = 0 if start < 0 else start + 2
+    heading_start = template.rfind("\n\n", 0, max(start - 2, 0)) + 2
+    heading = template[heading_start:start].strip()
+    if (len(heading) <= 40 and "\n" not in heading
+            and "input" in heading.lower()):
+        start = heading_start
+    end = template.find("\n\n", placeholders[-1].end())
+    end = len(template) if end < 0 else end
+    return template[:start] + template[end:].lstrip("\n"), template[start:end]
+
+
+def build_prompt(template, **fields):
+    # Returns (prev_messages, content) for get_response_async. With
+    # PROMPT_PREFIX_CACHING the static instructions become an identical
+    # system message for every sample and the per-sample data follows in the
+    # user message, so the server's prefix cache can reuse the instruction
+    # tokens across requests.
+    if TEXT_STRUCTURED_DECODING:
+        template = FORMAT_REMINDER_RE.sub("", template)
+    if not PROMPT_PREFIX_CACHING:
+        return [], template.format(**fields)
+    static, inputs = split_prompt_template(template)
+    return [{
+        "role": "system",
+        "content": static.format().strip()
+    }], inputs.format(**fields).strip()
+
+
 def openai_pack_content(prompt, images):
     image_list = images or []
     content = [{
@@ -571,24 +1124,178 @@ def openai_pack_content(prompt, images):
     return content
 
 
+def structured_decoding_params(client, stage, schema=None):
+    # Extra request fields that make the server enforce the stage's schema
+    # (OUTPUT_SCHEMAS[stage] unless given), or {}.
+    schema = schema or OUTPUT_SCHEMAS.get(stage)
+    mode = TEXT_STRUCTURED_DECODING if client is local_text_client else None
+    if not schema or not mode or client in structured_decoding_rejected:
+        return {}
+    if mode == "json_schema":
+        return {
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": stage,
+                    "schema": schema
+                }
+            }
+        }
+    if mode == "guided_json":
+        return {"extra_body": {"guided_json": schema}}
+    if mode == "json_object" and schema.get("type") == "object":
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+
+def get_endpoint_limiter(client):
+    return vl_limiter if client is local_vl_client else text_limiter
+
+
+def estimate_prompt_tokens(messages):
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                chars += len(part["text"])
+            else:
+                images += 1
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKEN_ESTIMATE
+
+
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0,
+                       parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def record_usage(model, result):
+    totals = usage_totals.setdefault(
+        model, {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "latency": 0.0
+        })
+    totals["requests"] += 1
+    totals["prompt_tokens"] += result.get("prompt_tokens") or 0
+    totals["completion_tokens"] += result.get("completion_tokens") or 0
+    totals["latency"] += result.get("latency") or 0.0
+
+
+def usage_fields(usage):
+    if usage is None:
+        return {"prompt_tokens": None, "completion_tokens": None}
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens
+    }
+
+
+async def call_with_retries(make_request, max_retries=3):
+    for attempt in range(max_retries):
+        retry_policy.on_request()
+        try:
+            return await make_request()
+        except RETRYABLE_ERRORS as e:
+            retry_policy.record_error(e)
+            print(
+                f"--- [Retryable Error] (Attempt {attempt + 1}/{max_retries}): {e}"
+            )
+            if attempt == max_retries - 1 or not retry_policy.allow_retry():
+                raise e
+            await asyncio.sleep(
+                retry_policy.backoff(attempt, get_retry_after(e)))
+        except Exception as e:
+            retry_policy.record_error(e)
+            print(f"--- [Fatal Error]: {e}")
+            raise e
+
+
 def process_qa_output(output_str):
-    output_str = output_str.strip()
-    if output_str.startswith("```json") and output_str.endswith("```"):
-        output_str = output_str[len("```json"):-len("```")].strip()
     try:
-        qa_list = json.loads(output_str)
-        return qa_list
-    except json.JSONDecodeError as e:
+        return parse_structured(output_str)[0]
+    except ParseError as e:
         print(f"JSON decoding error: {e}")
         return None
 
 
+async def get_json_response_async(prev_messages,
+                                  next_content,
+                                  stage,
+                                  model=TEXT_MODEL_NAME,
+                                  client=None):
+    # Sends the request and returns the parsed answer, validated against
+    # OUTPUT_SCHEMAS[stage] (and constrained to it where the server supports
+    # that). Only if that fails is the model asked to fix its own answer.
+    # Raises ParseError when it still cannot be used.
+    client = client or local_text_client
+    schema = OUTPUT_SCHEMAS.get(stage)
+    response = await get_response_async(
+        prev_messages,
+        next_content,
+        model,
+        client,
+        decoding=structured_decoding_params(client, stage, schema))
+    try:
+        value, repaired = parse_structured(response["content"], schema)
+        parse_stats.record(stage, "repaired" if repaired else "ok")
+        return value
+    except ParseError as e:
+        error = e
+    messages = prev_messages + [{"role": "user", "content": next_content}]
+    for _ in range(PARSE_REPAIR_ATTEMPTS):
+        messages = messages + [{
+            "role": "assistant",
+            "content": response["content"]
+        }]
+        repair_prompt = JSON_REPAIR_PROMPT.format(error=error).strip()
+        response = await get_response_async(
+            messages,
+            repair_prompt,
+            model,
+            client,
+            decoding=structured_decoding_params(client, stage, schema))
+        messages = messages + [{"role": "user", "content": repair_prompt}]
+        try:
+            value, _ = parse_structured(response["content"], schema)
+            parse_stats.record(stage, "reprompted")
+            return value
+        except ParseError as e:
+            error = e
+    parse_stats.record(stage, "failed")
+    raise error
+
+
 async def get_response_async(prev_messages,
                              next_content,
                              model,
                              client,
                              tools=None,
-                             max_retries=3):
+                             max_retries=3,
+                             use_cache=True,
+                             limiter=None,
+                             stream=None,
+                             decoding=None):
     if isinstance(next_content, str):
         user_content = next_content
     else:
@@ -596,47 +1303,114 @@ async def get_response_async(prev_messages,
 
     messages = prev_messages + [{"role": "user", "content": user_content}]
     MAX_TOKENS_LIMIT = 4096
+    request = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": MAX_TOKENS_LIMIT,
+        "temperature": 0.2
+    }
+    # Constrained decoding fields from structured_decoding_params().
+    request.update(decoding or {})
+    cache = response_cache if use_cache else None
+    if cache is not None:
+        cached = await cache.aget(request)
+        if cached is not None:
+            return cached
+    limiter = limiter or get_endpoint_limiter(client)
+    estimated_tokens = estimate_prompt_tokens(messages)
+
+    stream = STREAM_RESPONSES if stream is None else stream
+
+    async def make_request(request):
+        start = time.monotonic()
+        async with limiter.request(estimated_tokens) as handle:
+            if stream:
+                response = await client.chat.completions.create(
+                    **request,
+                    stream=True,
+                    stream_options={"include_usage": True})
+                parts = []
+                usage = None
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                answer_content = "".join(parts)
+            else:
+                response = await client.chat.completions.create(**request)
+                answer_content = response.choices[0].message.content or ""
+                usage = response.usage
+            result = {"content": answer_content}
+            result.update(usage_fields(usage))
+            if usage is not None:
+                handle.tokens = usage.prompt_tokens + usage.completion_tokens
+        result["latency"] = time.monotonic() - start
+        return result
 
-    for attempt in range(max_retries):
-        try:
-            answer_content = ""
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                stream=True,
-                max_tokens=MAX_TOKENS_LIMIT,
-                temperature=0.2)
-
-            async for chunk in response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    answer_content += chunk.choices[0].delta.content
-
-            return {"content": answer_content}
-
-        except (APIConnectionError, InternalServerError) as e:
-            print(
-                f"--- [Retryable Error] (Attempt {attempt + 1}/{max_retries}): {e}"
-            )
-            if attempt == max_retries - 1: raise e
-            await asyncio.sleep(5)
-        except Exception as e:
-            print(f"--- [Fatal Error]: {e}")
-            raise e
-
-
-def get_image_base64_from_source(img_info):
+    try:
+        result = await call_with_retries(lambda: make_request(request),
+                                         max_retries)
+    except BadRequestError:
+        if not decoding:
+            raise
+        # Most likely the server does not support constrained decoding. If
+        # the same request goes through without it, stop asking for it.
+        request = {k: v for k, v in request.items() if k not in decoding}
+        result = await call_with_retries(lambda: make_request(request),
+                                         max_retries)
+        if client not in structured_decoding_rejected:
+            structured_decoding_rejected.add(client)
+            print(f"--- Constrained decoding not supported by the endpoint "
+                  f"of {model}, falling back to parsing plain answers.")
+    record_usage(model, result)
+    if cache is not None:
+        await cache.aput(request, result)
+    return result
+
+
+def get_image_bytes_from_source(img_info,
+                                sample_index=None,
+                                image_index=None):
+    if image_pack is not None and sample_index in image_pack:
+        data = image_pack.get_bytes(sample_index, image_index)
+        if data is not None:
+            return data
     if img_info.get("image_base64"):
-        return img_info["image_base64"]
+        return base64.b64decode(img_info["image_base64"])
     local_path = img_info.get("local_path")
     if local_path and os.path.exists(local_path):
         try:
             with open(local_path, "rb") as f:
-                return base64.b64encode(f.read()).decode('utf-8')
+                return f.read()
         except:
             return None
     return None
 
 
+def get_image_base64_from_source(img_info,
+                                 sample_index=None,
+                                 image_index=None):
+    if image_pack is None and img_info.get("image_base64"):
+        return img_info["image_base64"]
+    data = get_image_bytes_from_source(img_info, sample_index, image_index)
+    if data is None:
+        return None
+    return base64.b64encode(data).decode('utf-8')
+
+
+async def get_vl_image_base64(img_info, sample_index, image_index):
+    if vl_image_cache is None:
+        return get_image_base64_from_source(img_info, sample_index,
+                                            image_index)
+    data = get_image_bytes_from_source(img_info, sample_index, image_index)
+    if data is None:
+        return None
+    # Decoding and re-encoding is CPU-bound, keep it off the event loop.
+    data = await asyncio.to_thread(vl_image_cache.get, data)
+    return base64.b64encode(data).decode('utf-8')
+
+
 def split_caption_data(item):
     captions_list = item.get("context_enhanced_captions", [])
     summary_data = item.get("context_enhanced_summary", {})
@@ -691,28 +1465,75 @@ def extract_observation_text(item):
 
 
 # --- Step 0: Filter ---
-async def check_biomedical_async(sample):
-    try:
-        back_info = sample.get("back_info", "")
-        if not back_info:
-            text_list = sample.get("text_list", [])
-            back_info = " ".join([t for t in text_list if isinstance(t, str)])
-
-        context_for_judge = back_info
-        prompt = BIOMED_CHECK_PROMPT.format(context=context_for_judge)
-        response = await get_response_async([], prompt, TEXT_MODEL_NAME,
-                                            local_text_client)
-        content = response["content"].strip()
+def get_biomed_context(sample):
+    back_info = sample.get("back_info", "")
+    if not back_info:
+        text_list = sample.get("text_list", [])
+        back_info = " ".join([t for t in text_list if isinstance(t, str)])
+    return back_info
 
-        if content.startswith("```json"): content = content[7:].strip()
-        if content.endswith("```"): content = content[:-3].strip()
 
-        is_biomedical = False
-        try:
-            res_json = json.loads(content)
-            is_biomedical = res_json.get("is_biomedical", False)
-        except:
-            if "true" in content.lower(): is_biomedical = True
+def parse_batch_answer(content, field, stage):
+    # JSON array of {"original_sample_index": ..., field: ...} objects ->
+    # {str(original_sample_index): value}. Unparseable answers map to {}; the
+    # samples are then re-sent one by one, so there is no repair re-prompt.
+    try:
+        entries, repaired = parse_structured(content, OUTPUT_SCHEMAS[stage])
+    except ParseError:
+        parse_stats.record(stage, "failed")
+        return {}
+    parse_stats.record(stage, "repaired" if repaired else "ok")
+    return {str(e["original_sample_index"]): e[field] for e in entries}
+
+
+async def check_biomedical_batch(samples):
+    # One request for K samples; items missing from the answer come back as
+    # None and are re-checked one by one.
+    items = "\n\n".join(
+        f"[Item original_sample_index={s.get('original_sample_index')}]\n"
+        f"{get_biomed_context(s)}" for s in samples)
+    prev_messages, prompt = build_prompt(BIOMED_CHECK_BATCH_PROMPT,
+                                         items=items)
+    try:
+        response = await get_response_async(
+            prev_messages,
+            prompt,
+            TEXT_MODEL_NAME,
+            local_text_client,
+            decoding=structured_decoding_params(local_text_client,
+                                                "step0_batch"))
+    except Exception as e:
+        print(f"Biomed Batch Error: {e}")
+        return [None] * len(samples)
+    verdicts = parse_batch_answer(response["content"], "is_biomedical",
+                                  "step0_batch")
+    results = []
+    for s in samples:
+        verdict = verdicts.get(str(s.get("original_sample_index")))
+        results.append(verdict if isinstance(verdict, bool) else None)
+    return results
+
+
+async def check_biomedical_async(sample, batcher=None):
+    try:
+        is_biomedical = None
+        if prefilter is not None:
+            is_biomedical = prefilter.decide(sample)
+        from_llm = is_biomedical is None
+        if from_llm and batcher is not None:
+            is_biomedical = await batcher.submit(sample)
+
+        if is_biomedical is None:
+            context_for_judge = get_biomed_context(sample)
+            prev_messages, prompt = build_prompt(BIOMED_CHECK_PROMPT,
+                                                 context=context_for_judge)
+            res_json = await get_json_response_async(
+                prev_messages, prompt, "step0")
+            is_biomedical = res_json["is_biomedical"]
+
+        if from_llm and step0_labels is not None:
+            step0_labels.add(sample.get("original_sample_index"),
+                             is_biomedical)
 
         if is_biomedical:
             raw_image_info = sample.get("image_info", [])
@@ -749,49 +1570,90 @@ async def check_biomedical_async(sample):
 
 
 # --- Step 1: Keywords ---
-async def extract_keywords_from_filtered_async(sample):
+def build_keyword_inputs(sample):
+    text_list = sample.get("text_list", [])
+    image_captions = sample.get("image_captions", [])
+    modified_text_list = []
+    image_insert_counter = 0
+    num_available_images = len(image_captions)
+
+    for text in text_list:
+        has_images_left = (image_insert_counter < num_available_images)
+        if text == "" and has_images_left:
+            modified_text_list.append(f" [Image {image_insert_counter + 1}]")
+            image_insert_counter += 1
+        elif isinstance(text, str) and text.startswith(")") and has_images_left:
+            modified_text_list.append(
+                f" [Image {image_insert_counter + 1}]{text}")
+            image_insert_counter += 1
+        else:
+            modified_text_list.append(str(text))
+
+    context = "".join(modified_text_list)
+    formatted_captions_for_llm = [
+        f"Image {img['image_index']}: {img['caption']}"
+        for img in image_captions
+    ]
+    return context, json.dumps(formatted_captions_for_llm,
+                               ensure_ascii=False,
+                               indent=2)
+
+
+async def extract_keywords_batch(samples):
+    blocks = []
+    for s in samples:
+        context, image_caption = build_keyword_inputs(s)
+        blocks.append(
+            f"### Item original_sample_index={s.get('original_sample_index')}"
+            f"\n[Context]:\n{context}\n\n[Image_caption]:\n{image_caption}")
+    prev_messages, prompt = build_prompt(
+        KEYWORD_Category_BATCH_PROMPT_TEMPLATE, items="\n\n".join(blocks))
+    try:
+        response = await get_response_async(
+            prev_messages,
+            prompt,
+            TEXT_MODEL_NAME,
+            local_text_client,
+            decoding=structured_decoding_params(local_text_client,
+                                                "step1_batch"))
+    except Exception as e:
+        print(f"Keyword Batch Error: {e}")
+        return [None] * len(samples)
+    keywords = parse_batch_answer(response["content"], "keywords",
+                                  "step1_batch")
+    results = []
+    for s in samples:
+        kw = keywords.get(str(s.get("original_sample_index")))
+        results.append(
+            kw.strip() if isinstance(kw, str) and kw.strip() else None)
+    return results
+
+
+async def extract_keywords_from_filtered_async(sample, batcher=None):
     orig_idx = sample.get("original_sample_index", "N/A")
     try:
-        text_list = sample.get("text_list", [])
         image_captions = sample.get("image_captions", [])
-        modified_text_list = []
-        image_insert_counter = 0
-        num_available_images = len(image_captions)
-
-        for text in text_list:
-            has_images_left = (image_insert_counter < num_available_images)
-            if text == "" and has_images_left:
-                modified_text_list.append(
-                    f" [Image {image_insert_counter + 1}]")
-                image_insert_counter += 1
-            elif isinstance(text,
-                            str) and text.startswith(")") and has_images_left:
-                modified_text_list.append(
-                    f" [Image {image_insert_counter + 1}]{text}")
-                image_insert_counter += 1
-            else:
-                modified_text_list.append(str(text))
-
-        context = "".join(modified_text_list)
-        formatted_captions_for_llm = [
-            f"Image {img['image_index']}: {img['caption']}"
-            for img in image_captions
-        ]
-
-        kw_prompt = KEYWORD_Category_PROMPT_TEMPLATE.format(
-            context=context,
-            image_caption=json.dumps(formatted_captions_for_llm,
-                                     ensure_ascii=False,
-                                     indent=2))
-        response = await get_response_async([], kw_prompt, TEXT_MODEL_NAME,
-                                            local_text_client)
+        context, image_caption = build_keyword_inputs(sample)
+
+        keywords = None
+        if batcher is not None:
+            keywords = await batcher.submit(sample)
+        if keywords is None:
+            prev_messages, kw_prompt = build_prompt(
+                KEYWORD_Category_PROMPT_TEMPLATE,
+                context=context,
+                image_caption=image_caption)
+            response = await get_response_async(prev_messages, kw_prompt,
+                                                TEXT_MODEL_NAME,
+                                                local_text_client)
+            keywords = response["content"].strip()
 
         return {
             "status": "success",
             "original_sample_index": orig_idx,
             "context": context,
             "image_captions": image_captions,
-            "extracted_keywords": response["content"].strip(),
+            "extracted_keywords": keywords,
             "back_info": sample.get("back_info", "")
         }
     except Exception as e:
@@ -810,10 +1672,11 @@ async def process_single_sample_background(result_item):
     if len(back_info.split()) < 200:
         return oid, {"status": "success", "distilled_background": back_info}
 
-    prompt = BACKGROUND_DISTILLATION_PROMPT_TEMPLATE.format(
-        back_info=back_info)
+    prev_messages, prompt = build_prompt(
+        BACKGROUND_DISTILLATION_PROMPT_TEMPLATE, back_info=back_info)
     try:
-        response = await get_response_async([], prompt, TEXT_MODEL_NAME,
+        response = await get_response_async(prev_messages, prompt,
+                                            TEXT_MODEL_NAME,
                                             local_text_client)
         return oid, {
             "status": "success",
@@ -824,95 +1687,279 @@ async def process_single_sample_background(result_item):
 
 
 # --- Step 2b: VLM Enhancement ---
-async def process_sample_vlm(lightweight_item, source_map, semaphore):
-    orig_id = lightweight_item.get("original_sample_index")
-    raw_sample = source_map.get(orig_id) or source_map.get(str(orig_id))
-    if not raw_sample: return orig_id, []
+def build_vl_request(model, prompt, image_base64_list, max_tokens=512):
+    content = [{"type": "text", "text": prompt}] + [{
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{base64_str}"
+        }
+    } for base64_str in image_base64_list]
+    return {
+        "model": model,
+        "messages": [{
+            "role": "user",
+            "content": content
+        }],
+        "max_tokens": max_tokens,
+        "temperature": 0.2
+    }
 
-    image_info_list = raw_sample.get("image_info", [])
-    enhanced_results = []
 
-    for img_info in image_info_list:
-        base64_str = get_image_base64_from_source(img_info)
+async def get_vl_response_async(request, client, limiter, max_retries=3):
+    cached = await response_cache.aget(request) if response_cache else None
+    if cached is not None:
+        return cached
+
+    async def make_request():
+        start = time.monotonic()
+        async with limiter.request(estimate_prompt_tokens(
+                request["messages"])) as handle:
+            response = await client.chat.completions.create(**request)
+            if response.usage is not None:
+                handle.tokens = (response.usage.prompt_tokens +
+                                 response.usage.completion_tokens)
+        result = {"content": response.choices[0].message.content}
+        result.update(usage_fields(response.usage))
+        result["latency"] = time.monotonic() - start
+        return result
+
+    result = await call_with_retries(make_request, max_retries)
+    record_usage(request["model"], result)
+    if response_cache is not None:
+        await response_cache.aput(request, result)
+    return result
+
+
+def endpoint_limits(limits):
+    if SHARD and SHARD_SPLIT_LIMITS:
+        return scale_limits(limits, SHARD[1])
+    return limits
+
+
+def build_vl_endpoints():
+    endpoints = []
+    for name, cfg in VL_MODELS.items():
+        if cfg.get("base_url"):
+            client = AsyncOpenAI(api_key=cfg.get("api_key"),
+                                 base_url=cfg["base_url"],
+                                 timeout=120.0,
+                                 max_retries=0)
+            limiter = EndpointLimiter(
+                name,
+                overload_errors=RETRYABLE_ERRORS,
+                **endpoint_limits(cfg.get("limits", VL_ENDPOINT_LIMITS)))
+        else:
+            # Entries without their own endpoint use the default VL client.
+            client, limiter = local_vl_client, vl_limiter
+        endpoints.append(
+            VLEndpoint(name, cfg.get("display_name", name), cfg["model"],
+                       client, limiter, cfg.get("timeout"),
+                       cfg.get("multi_image", VL_MULTI_IMAGE_REQUEST)))
+    return endpoints
+
+
+async def describe_image(endpoint, img_info, orig_id, image_index):
+    prompt = VLM_PROMPT_TEMPLATE.format(caption=img_info.get("caption", ""))
+    try:
+        # Inside the try: a failing image read or cache write only costs
+        # this image its description.
+        base64_str = await get_vl_image_base64(img_info, orig_id, image_index)
         if not base64_str:
-            enhanced_results.append("ERROR: Image data missing")
-            continue
+            return "ERROR: Image data missing"
+        result = await get_vl_response_async(
+            build_vl_request(endpoint.model, prompt, [base64_str]),
+            endpoint.client, endpoint.limiter)
+        return result["content"]
+    except Exception as e:
+        return f"ERROR: {e}"
 
-        prompt = VLM_PROMPT_TEMPLATE.format(
-            caption=img_info.get("caption", ""))
-        async with semaphore:
-            try:
-                response = await local_vl_client.chat.completions.create(
-                    model=VL_MODEL_NAME,
-                    messages=[{
-                        "role":
-                        "user",
-                        "content": [{
-                            "type": "text",
-                            "text": prompt
-                        }, {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_str}"
-                            }
-                        }]
-                    }],
-                    max_tokens=512,
-                    temperature=0.2)
-                enhanced_results.append(response.choices[0].message.content)
-            except Exception as e:
-                enhanced_results.append(f"ERROR: {e}")
-
-    structured_captions = [{
+
+async def describe_images_together(endpoint, image_info_list, orig_id):
+    # One multi-image request for the whole sample. Returns None when the
+    # answer cannot be mapped back to the images, so the caller can fall back
+    # to one request per image.
+    try:
+        base64_list = await asyncio.gather(*[
+            get_vl_image_base64(img_info, orig_id, i + 1)
+            for i, img_info in enumerate(image_info_list)
+        ])
+    except Exception:
+        # The per-image requests report the failing image.
+        return None
+    if not all(base64_list):
+        return None
+    captions = "\n".join(f"Image {i + 1}: {img_info.get('caption', '')}"
+                         for i, img_info in enumerate(image_info_list))
+    prompt = VLM_MULTI_IMAGE_PROMPT_TEMPLATE.format(
+        num_images=len(image_info_list), captions=captions)
+    try:
+        result = await get_vl_response_async(
+            build_vl_request(endpoint.model,
+                             prompt,
+                             base64_list,
+                             max_tokens=512 * len(image_info_list)),
+            endpoint.client, endpoint.limiter)
+        try:
+            descriptions, repaired = parse_structured(
+                result["content"],
+                image_map_schema(range(1,
+                                       len(image_info_list) + 1)))
+        except ParseError:
+            parse_stats.record("step2b_multi", "failed")
+            raise
+        parse_stats.record("step2b_multi", "repaired" if repaired else "ok")
+        return [
+            descriptions[f"Image {i + 1}"]
+            for i in range(len(image_info_list))
+        ]
+    except Exception as e:
+        print(f"Multi-image VLM Error ({endpoint.name}): {e}")
+        return None
+
+
+async def describe_sample_with_model(endpoint, image_info_list, orig_id):
+    enhanced_results = None
+    if endpoint.multi_image and len(image_info_list) > 1:
+        enhanced_results = await describe_images_together(
+            endpoint, image_info_list, orig_id)
+    if enhanced_results is None:
+        # Images of a sample are independent; the limiter bounds how many
+        # requests are actually in flight. gather keeps the image order.
+        enhanced_results = await asyncio.gather(*[
+            describe_image(endpoint, img_info, orig_id, i + 1)
+            for i, img_info in enumerate(image_info_list)
+        ])
+    return [{
         "image_index":
         i + 1,
         "description":
         str(res).replace("[Enhanced Captions]:", "").strip()
     } for i, res in enumerate(enhanced_results)]
-    return orig_id, structured_captions
 
 
-# --- Step 3.5: Consensus ---
-async def process_sample_consensus(item):
-    # This is a simplified version, assuming only the results from the current VLM are used.
-    # If there are other model files, they need to be loaded and merged into `desc_map` here.
-    desc_map = {
-        "qwenvl": "",  # Placeholder
+async def process_sample_vlm(lightweight_item, source_map, endpoints):
+    # Fans the sample out to every configured VL model in parallel. A model
+    # that does not finish within its timeout is left out of this sample's
+    # results instead of stalling it.
+    orig_id = lightweight_item.get("original_sample_index")
+    raw_sample = source_map.get(orig_id) or source_map.get(str(orig_id))
+    if not raw_sample: return orig_id, {}
+
+    image_info_list = raw_sample.get("image_info", [])
+
+    async def run_model(endpoint):
+        try:
+            return await asyncio.wait_for(
+                describe_sample_with_model(endpoint, image_info_list,
+                                           orig_id), endpoint.timeout)
+        except asyncio.TimeoutError:
+            print(f"VLM Timeout ({endpoint.name}): sample {orig_id}")
+            return None
+
+    results = await asyncio.gather(*[run_model(ep) for ep in endpoints])
+    return orig_id, {
+        ep.name: caps
+        for ep, caps in zip(endpoints, results) if caps is not None
     }
 
 
-    vlm_caps = item.get("model-enhanced captions", [])
-    vlm_map = {x["image_index"]: x["description"] for x in vlm_caps}
+# --- Step 3.5: Consensus ---
+def is_valid_description(desc):
+    return bool(desc) and not desc.startswith("ERROR")
+
 
-    output_entry = item.copy()
-    output_entry["consensus_image_descriptions"] = []
+def format_observations(descriptions):
+    return "\n\n".join(f"[Model: {display_name}]:\n{desc}"
+                       for display_name, desc in descriptions)
 
-    image_info_list = item.get("image_captions", [])
-    for img_info in image_info_list:
-        idx = img_info.get("image_index")
-        desc_map["qwenvl"] = vlm_map.get(idx, "")
 
-        # If only a single model is used, directly use the single model's result, or generate a consensus based on the prompt requirements.
-        # Here, for demonstration purposes, we call the Consensus Prompt, even though there is only one input.
-        prompt = CONSENSUS_PROMPT_TEMPLATE.format(
-            desc_fleming="N/A",
-            desc_hulu="N/A",
-            desc_lingshu="N/A",
-            desc_qwenvl=desc_map["qwenvl"])
+async def consensus_single_image(descriptions):
+    prev_messages, prompt = build_prompt(
+        CONSENSUS_PROMPT_TEMPLATE,
+        observations=format_observations(descriptions))
+    try:
+        res = await get_response_async(prev_messages, prompt, TEXT_MODEL_NAME,
+                                       local_text_client)
+        return res['content'].strip()
+    except:
+        return descriptions[0][1]  # Fallback
+
+
+async def consensus_batch(descriptions_by_image):
+    # All images of the sample in one request. Returns None if the answer
+    # cannot be mapped back to every image.
+    observations = "\n\n".join(
+        f"## Image {idx}\n{format_observations(descriptions)}"
+        for idx, descriptions in descriptions_by_image.items())
+    prev_messages, prompt = build_prompt(CONSENSUS_BATCH_PROMPT_TEMPLATE,
+                                         observations=observations)
+    schema = image_map_schema(descriptions_by_image)
+    try:
+        res = await get_response_async(
+            prev_messages,
+            prompt,
+            TEXT_MODEL_NAME,
+            local_text_client,
+            decoding=structured_decoding_params(local_text_client,
+                                                "step3_5_batch", schema))
         try:
-            res = await get_response_async([], prompt, TEXT_MODEL_NAME,
-                                           local_text_client)
-            consensus_text = res['content'].strip()
-        except:
-            consensus_text = desc_map["qwenvl"]  # Fallback
+            merged, repaired = parse_structured(res['content'], schema)
+        except ParseError:
+            parse_stats.record("step3_5_batch", "failed")
+            raise
+        parse_stats.record("step3_5_batch", "repaired" if repaired else "ok")
+        return {
+            idx: merged[f"Image {idx}"].strip()
+            for idx in descriptions_by_image
+        }
+    except Exception as e:
+        print(f"Consensus Batch Error: {e}")
+        return None
 
-        output_entry["consensus_image_descriptions"].append({
-            "image_index":
-            idx,
-            "description":
-            consensus_text
-        })
-    return output_entry
+
+async def process_sample_consensus(item):
+    # Merges the descriptions of every VL model that answered for the sample.
+    vlm_captions = item.get("vlm_captions") or {
+        VL_CONSENSUS_FALLBACK_NAME: item.get("model-enhanced captions", [])
+    }
+    desc_maps = {
+        name: {x["image_index"]: x["description"]
+               for x in caps}
+        for name, caps in vlm_captions.items()
+    }
+
+    consensus = {}
+    to_merge = {}
+    image_indices = [
+        img_info.get("image_index")
+        for img_info in item.get("image_captions", [])
+    ]
+    for idx in image_indices:
+        descriptions = [(VL_MODELS.get(name, {}).get("display_name", name),
+                         desc_map.get(idx, ""))
+                        for name, desc_map in desc_maps.items()]
+        descriptions = [(n, d) for n, d in descriptions
+                        if is_valid_description(d)]
+        if len(descriptions) < 2:
+            # Nothing to vote on: pass the single description through.
+            consensus[idx] = descriptions[0][1] if descriptions else ""
+        else:
+            to_merge[idx] = descriptions
+
+    merged = None
+    if CONSENSUS_BATCH and len(to_merge) > 1:
+        merged = await consensus_batch(to_merge)
+    if merged is None:
+        merged_texts = await asyncio.gather(
+            *[consensus_single_image(d) for d in to_merge.values()])
+        merged = dict(zip(to_merge, merged_texts))
+    consensus.update(merged)
+
+    item["consensus_image_descriptions"] = [{
+        "image_index": idx,
+        "description": consensus[idx]
+    } for idx in image_indices]
+    return item
 
 
 # --- Step 3: Context Enhanced ---
@@ -921,21 +1968,15 @@ async def process_enhanced_caption_gen(item):
                                             []),
                                    indent=2,
                                    ensure_ascii=False)
-    prompt = ENHANCED_CAPTION_PROMPT_TEMPLATE.format(
+    prev_messages, prompt = build_prompt(
+        ENHANCED_CAPTION_PROMPT_TEMPLATE,
         distilled_background=item.get("distilled_background", ""),
         keywords=item.get("extracted_keywords", ""),
         context=item.get("context", ""),
         vl_captions_json=captions_json_str)
     try:
-        response = await get_response_async([], prompt, TEXT_MODEL_NAME,
-                                            local_text_client)
-        content = response['content'].strip()
-        if "```" in content:
-            match = re.search(r"```(?:json)?(.*?)```", content, re.DOTALL)
-            if match: content = match.group(1).strip()
-
-        data = json.loads(content)
-        core_data = data.get("Context_Enhanced_Captions", data)
+        data = await get_json_response_async(prev_messages, prompt, "step3")
+        core_data = data["Context_Enhanced_Captions"]
 
         obs_dict = core_data.get("observations", {})
 
@@ -972,21 +2013,13 @@ async def run_visual_qa_task(item):
     obs_str = extract_observation_text(item)
     if not obs_str: return None
 
-    prompt = VISUAL_ELEMENT_QA_PROMPT_TEMPLATE.format(Observation=obs_str)
+    prev_messages, prompt = build_prompt(VISUAL_ELEMENT_QA_PROMPT_TEMPLATE,
+                                         Observation=obs_str)
     try:
-        result = await get_response_async([], prompt, TEXT_MODEL_NAME,
-                                          local_text_client)
-        content = result["content"].strip()
-        if "```" in content:
-            match = re.search(r"```(?:json)?(.*?)```", content, re.DOTALL)
-            if match: content = match.group(1).strip()
-
-        qa_list = json.loads(content)
-        if not qa_list: return None
-
-        result_data = item.copy()
-        result_data["visual_qa"] = qa_list[0]
-        return result_data
+        qa_list = await get_json_response_async(prev_messages, prompt,
+                                                "step4")
+        item["visual_qa"] = qa_list[0]
+        return item
     except Exception as e:
         print(f"Visual QA Error: {e}")
         return None
@@ -998,18 +2031,16 @@ async def run_logic_chain_task(item):
     obs_str, _ = split_caption_data(item)
     context_str = item.get("context", "")
 
-    prompt = LOGIC_CHAIN_PROMPT_TEMPLATE.format(observation=obs_str,
-                                                context=context_str)
+    prev_messages, prompt = build_prompt(LOGIC_CHAIN_PROMPT_TEMPLATE,
+                                         observation=obs_str,
+                                         context=context_str)
     try:
         content_packed = openai_pack_content(prompt, None)
-        result = await get_response_async([], content_packed, TEXT_MODEL_NAME,
-                                          local_text_client)
-        logic_chain_json = process_qa_output(result["content"])
-        if not logic_chain_json: raise Exception("Empty logic chain")
+        logic_chain_json = await get_json_response_async(
+            prev_messages, content_packed, "step5")
 
-        result_data = item.copy()
-        result_data["logic_chain"] = logic_chain_json
-        return result_data
+        item["logic_chain"] = logic_chain_json
+        return item
     except Exception as e:
         print(f"Logic Chain Error: {e}")
         return None
@@ -1021,15 +2052,20 @@ async def run_logic_based_qa_task(item):
     obs_str, _ = split_caption_data(item)
     context_str = item.get("context", "")
 
-    prompt = OPEN_ENDED_QA_GENERATION_PROMPT_TEMPLATE.format(
+    prev_messages, prompt = build_prompt(
+        OPEN_ENDED_QA_GENERATION_PROMPT_TEMPLATE,
         logic_chain=json.dumps(logic_chain[0], ensure_ascii=False, indent=2),
         visual_evidence=obs_str,
         original_text=context_str)
     try:
         content_packed = openai_pack_content(prompt, None)
-        result = await get_response_async([], content_packed, TEXT_MODEL_NAME,
-                                          local_text_client)
-        qa_pair = process_qa_output(result["content"])
+        try:
+            qa_pair = await get_json_response_async(prev_messages,
+                                                    content_packed, "step6")
+        except ParseError as e:
+            # Kept as before: the record survives with an empty basic_qa.
+            print(f"JSON decoding error: {e}")
+            qa_pair = None
 
         result_data = {
             "original_sample_index": item.get("original_sample_index"),
@@ -1044,121 +2080,586 @@ async def run_logic_based_qa_task(item):
         return None
 
 
-# ================= MAIN EXECUTION =================
+# --- Step 7: Automated QC ---
+SCORES_RE = re.compile(r"<scores>(.*?)(?:</scores>|$)", re.DOTALL)
+EXPLANATION_RE = re.compile(r"<explanation>(.*?)(?:</explanation>|$)",
+                            re.DOTALL)
+
+
+def extract_quality_score(content):
+    # (scores, explanation) of a QC answer; raises ParseError.
+    match = SCORES_RE.search(content)
+    if not match:
+        raise ParseError("no <scores> block in the answer")
+    scores, _ = parse_structured(match.group(1), {"type": "object"})
+    explanation = EXPLANATION_RE.search(content)
+    return scores, explanation.group(1).strip() if explanation else ""
+
+
+def flatten_logic_chain(chain):
+    # The first logic chain as numbered sentences, as QC1 expects.
+    lines = []
+    if chain.get("research_context"):
+        lines.append(f"Research Context: {chain['research_context']}")
+    for i, exp in enumerate(chain.get("experiments", [])):
+        setting = exp.get("experimental_setting", "standard setting")
+        phenomenon = exp.get("visual_phenomenon", "observed phenomenon")
+        result = exp.get("sub_conclusion", "observed result")
+        lines.append(f"Experiment {i + 1}: In the setting of {setting}, "
+                     f"the visual phenomenon observed was {phenomenon}, "
+                     f"which indicates {result}.")
+    reasoning = chain.get("reasoning", {})
+    inferences = reasoning.get("intermediate_inferences", [])
+    refs = [
+        str(r) for inf in inferences
+        for r in inf.get("based_on_experiments", [])
+    ]
+    # Experiments are numbered from 1 above; shift 0-based references.
+    offset = 1 if "0" in refs else 0
+    for i, inf in enumerate(inferences):
+        based_on = ", ".join(
+            str(int(r) + offset) if str(r).isdigit() else str(r)
+            for r in inf.get("based_on_experiments", []))
+        lines.append(f"Intermediate Inference {i + 1}: Derived from "
+                     f"Experiment {based_on}, it is inferred that "
+                     f"{inf.get('sub_conclusion', '')}.")
+    content = reasoning.get("content", "")
+    conclusion = reasoning.get("conclusion", "")
+    if content or conclusion:
+        lines.append(f"Final Conclusion: Synthesizing the above, {content}. "
+                     f"Therefore, {conclusion}.")
+    return "\n".join(lines)
+
+
+def extract_visual_phenomena(chain):
+    # Numbered visual phenomena of the chain without their [Image X] tags.
+    lines = []
+    for exp in chain.get("experiments", []):
+        text = re.sub(r"\s*\[.*?\]", "", exp.get("visual_phenomenon", ""))
+        text = text.strip().replace(" .", ".")
+        if text:
+            lines.append(f"{len(lines) + 1}. "
+                         f"{text if text.endswith('.') else text + '.'}")
+    return "\n".join(lines)
+
+
+def build_qc_checks(item):
+    # {check: (template, fields)}, or None if the sample lacks an input.
+    chains = item.get("input_logic_chain")
+    chain = chains[0] if isinstance(chains, list) and chains else chains
+    question = (item.get("basic_qa") or {}).get("question", "")
+    if not isinstance(chain, dict) or not question:
+        return None
+    flattened = flatten_logic_chain(chain)
+    phenomena = extract_visual_phenomena(chain)
+    conclusion = chain.get("conclusion") or chain.get("reasoning", {}).get(
+        "conclusion", "")
+    if not (flattened and phenomena and conclusion):
+        return None
+    return {
+        "qc1": (LOGIC_CHAIN_QC_1_TEMPLATE, {
+            "flattened_logic_chain": flattened
+        }),
+        "qc2": (LOGIC_CHAIN_QC_2_TEMPLATE, {
+            "Observation": item.get("input_observation", ""),
+            "Context": item.get("input_context", ""),
+            "VisualPhenomena": phenomena
+        }),
+        "qc3": (LOGIC_CHAIN_QC_3_TEMPLATE, {
+            "Question": question,
+            "Observation": item.get("input_observation", ""),
+            "LogicChain": json.dumps(chains, ensure_ascii=False, indent=2),
+            "Conclusion": conclusion
+        })
+    }
 
 
-async def main():
-    # The `data_final` file corresponds to the data in `qa_generation_quickly.json`, and contains only filtered biomedical data. If you want to see the results of the first filtering step, you can use `source_data.json`, which includes non-biomedical data.
-    INPUT_SOURCE_FILE = 'Data\qa_generation_quickly.json'
+def qc_passed(scores, thresholds):
+    for key, minimum in thresholds.items():
+        try:
+            if float(scores.get(key)) < minimum:
+                return False
+        except (TypeError, ValueError):
+            return False
+    return True
+
+
+async def run_qc_check(name, template, fields):
+    # (passed, scores, explanation) of one check. A reply that cannot be
+    # parsed fails the check.
+    prev_messages, prompt = build_prompt(template, **fields)
+    response = await get_response_async(prev_messages, prompt,
+                                        TEXT_MODEL_NAME, local_text_client)
+    try:
+        scores, explanation = extract_quality_score(response["content"])
+    except ParseError as e:
+        parse_stats.record(f"step7_{name}", "failed")
+        return False, {}, f"Unparseable QC reply: {e}"
+    parse_stats.record(f"step7_{name}", "ok")
+    return qc_passed(scores, QC_THRESHOLDS[name]), scores, explanation
+
+
+async def run_qc_checks(checks):
+    # Runs the checks concurrently. Returns (results, first failed check or
+    # None); once a check fails, the ones still running are cancelled.
+    tasks = {
+        asyncio.create_task(run_qc_check(name, template, fields)): name
+        for name, (template, fields) in checks.items()
+    }
+    pending = set(tasks)
+    results = {}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks[task]
+                results[name] = task.result()
+                if not results[name][0]:
+                    return results, name
+        return results, None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def run_qc_task(item):
+    checks = build_qc_checks(item)
+    if checks is None:
+        outcome = "incomplete"
+    else:
+        # Checks finish in any order; outputs follow this one.
+        names = list(checks)
+        if QC_FIRST_CHECK_GATES:
+            results, failed = await run_qc_checks({"qc1": checks.pop("qc1")})
+            if failed is None:
+                more, failed = await run_qc_checks(checks)
+                results.update(more)
+        else:
+            results, failed = await run_qc_checks(checks)
+        outcome = f"failed_{failed}" if failed else "passed"
+    qc_stats[outcome] = qc_stats.get(outcome, 0) + 1
+    if outcome != "passed":
+        return None
+    item["qc_scores"] = {name: results[name][1] for name in names}
+    item["qc_explanations"] = {name: results[name][2] for name in names}
+    return item
+
+
+# ================= PIPELINE STAGES =================
+# Per-sample adapters: each takes one item and returns the item for the next
+# stage, or None if the sample drops out. Both the barrier and the streaming
+# runner are driven by the same stage table.
+
+# `prompts` and `model` feed the checkpoint fingerprint of the stage.
+# `cache_drops` marks stages where None is a real verdict (e.g. filtered out)
+# rather than a failure that should be retried on the next run.
+VLEndpoint = namedtuple("VLEndpoint", [
+    "name", "display_name", "model", "client", "limiter", "timeout",
+    "multi_image"
+])
+
+Stage = namedtuple("Stage", ["key", "name", "out_file", "fn", "prompts",
+                             "model", "cache_drops"],
+                   defaults=[False])
+
+
+async def stage_filter(sample, batcher=None):
+    r = await check_biomedical_async(sample, batcher)
+    if r["status"] == "error":
+        raise RuntimeError(r["error"])
+    return r["data"] if r["status"] == "valid" else None
+
+
+async def stage_keywords(sample, batcher=None):
+    r = await extract_keywords_from_filtered_async(sample, batcher)
+    return r if r["status"] == "success" else None
+
+
+async def stage_distillation(item):
+    _, r = await process_single_sample_background(item)
+    if r["status"] == "error":
+        raise RuntimeError(r["error_message"])
+    item["distilled_background"] = r.get("distilled_background", "")
+    return item
+
+
+async def stage_vlm(item, source_map, endpoints):
+    _, captions_by_model = await process_sample_vlm(item, source_map,
+                                                    endpoints)
+    item["vlm_captions"] = captions_by_model
+    # Captions of the first model that answered, kept for single-model use.
+    item["model-enhanced captions"] = next(iter(captions_by_model.values()),
+                                           [])
+    return item
+
+
+def build_text_batchers():
+    filter_batcher = MicroBatcher(
+        check_biomedical_batch, FILTER_BATCH_SIZE,
+        TEXT_BATCH_MAX_WAIT) if FILTER_BATCH_SIZE > 1 else None
+    keyword_batcher = MicroBatcher(
+        extract_keywords_batch, KEYWORD_BATCH_SIZE,
+        TEXT_BATCH_MAX_WAIT) if KEYWORD_BATCH_SIZE > 1 else None
+    return filter_batcher, keyword_batcher
+
+
+def build_pipeline_stages(source_map, text_batchers=(None, None)):
+    vl_endpoints = build_vl_endpoints()
+    filter_batcher, keyword_batcher = text_batchers
+    stages = [
+        Stage("step0", "Step 0: Filtering", "step0_filtered.json",
+              lambda sample: stage_filter(sample, filter_batcher),
+              (BIOMED_CHECK_PROMPT, ) +
+              ((BIOMED_CHECK_BATCH_PROMPT, ) if filter_batcher else ()) +
+              # Fingerprints are chained, so this covers the later stages.
+              (("layout:system-prefix", ) if PROMPT_PREFIX_CACHING else ()) +
+              ((f"decoding:{TEXT_STRUCTURED_DECODING}", )
+               if TEXT_STRUCTURED_DECODING else ()) +
+              ((f"prefilter:{prefilter.fingerprint()}", )
+               if prefilter else ()),
+              TEXT_MODEL_NAME, True),
+        Stage("step1", "Step 1: Keywords", "step1_keywords.json",
+              lambda sample: stage_keywords(sample, keyword_batcher),
+              (KEYWORD_Category_PROMPT_TEMPLATE, ) +
+              ((KEYWORD_Category_BATCH_PROMPT_TEMPLATE, )
+               if keyword_batcher else ()), TEXT_MODEL_NAME),
+        Stage("step2", "Step 2: Distillation", "step2_distilled.json",
+              stage_distillation, (BACKGROUND_DISTILLATION_PROMPT_TEMPLATE, ),
+              TEXT_MODEL_NAME),
+        Stage("step2b", "Step 2b: VLM Enhancement", "step2b_vlm.json",
+              lambda item: stage_vlm(item, source_map, vl_endpoints),
+              (VLM_PROMPT_TEMPLATE, ) +
+              ((VLM_MULTI_IMAGE_PROMPT_TEMPLATE, )
+               if any(ep.multi_image for ep in vl_endpoints) else ()),
+              ",".join(ep.model for ep in vl_endpoints)),
+        Stage("step3_5", "Step 3.5: Consensus", "step3_5_consensus.json",
+              process_sample_consensus,
+              (CONSENSUS_PROMPT_TEMPLATE, ) +
+              ((CONSENSUS_BATCH_PROMPT_TEMPLATE, ) if CONSENSUS_BATCH else
+               ()), TEXT_MODEL_NAME),
+        Stage("step3", "Step 3: Enhancement", "step3_enhanced.json",
+              process_enhanced_caption_gen,
+              (ENHANCED_CAPTION_PROMPT_TEMPLATE, ), TEXT_MODEL_NAME),
+        Stage("step4", "Step 4: Visual QA", "step4_visual_qa.json",
+              run_visual_qa_task, (VISUAL_ELEMENT_QA_PROMPT_TEMPLATE, ),
+              TEXT_MODEL_NAME),
+        Stage("step5", "Step 5: Logic Chain", "step5_logic_chain.json",
+              run_logic_chain_task, (LOGIC_CHAIN_PROMPT_TEMPLATE, ),
+              TEXT_MODEL_NAME),
+        Stage("step6", "Step 6: Final Logic QA", FINAL_OUTPUT,
+              run_logic_based_qa_task,
+              (OPEN_ENDED_QA_GENERATION_PROMPT_TEMPLATE, ), TEXT_MODEL_NAME),
+    ]
+    if RUN_QC:
+        # None is the verdict here, so dropped samples are checkpointed too.
+        stages.append(
+            Stage("step7", "Step 7: Automated QC", QC_OUTPUT, run_qc_task,
+                  (LOGIC_CHAIN_QC_1_TEMPLATE, LOGIC_CHAIN_QC_2_TEMPLATE,
+                   LOGIC_CHAIN_QC_3_TEMPLATE,
+                   json.dumps(QC_THRESHOLDS, sort_keys=True)),
+                  TEXT_MODEL_NAME, True))
+    return [
+        stage._replace(out_file=shard_path(stage.out_file, SHARD))
+        for stage in stages
+    ]
 
-    FILE_STEP0 = "step0_filtered.json"
-    FILE_STEP1 = "step1_keywords.json"
-    FILE_STEP2 = "step2_distilled.json"
-    FILE_STEP2B = "step2b_vlm.json"
-    FILE_STEP3_5 = "step3_5_consensus.json"
-    FILE_STEP3 = "step3_enhanced.json"
-    FILE_STEP4 = "step4_visual_qa.json"
-    FILE_STEP5 = "step5_logic_chain.json"
-    FINAL_OUTPUT = "final_qa_dataset.json"
 
+def with_checkpoints(stages, store):
+    # Wrap every stage so finished samples are read back from the store and
+    # new results are appended to it as soon as they complete.
+    wrapped = []
+    parent = None
+    for stage in stages:
+        fingerprint = stage_fingerprint(parent, stage.model, *stage.prompts)
+        parent = fingerprint
 
-    if not os.path.exists(INPUT_SOURCE_FILE):
-        print(f"Error: {INPUT_SOURCE_FILE} not found.")
-        return
-    with open(INPUT_SOURCE_FILE, 'r', encoding='utf-8') as f:
-        raw_data = json.load(f)
-    print(f"Loaded {len(raw_data)} items.")
-
-    # 2. Step 0: Filter
-    print("\n--- Running Step 0: Filtering ---")
-    tasks = [check_biomedical_async(s) for s in raw_data]
-    res0 = await tqdm_asyncio.gather(*tasks)
-    step0_data = [r["data"] for r in res0 if r["status"] == "valid"]
-    with open(FILE_STEP0, 'w', encoding='utf-8') as f:
-        json.dump(step0_data, f, indent=2, ensure_ascii=False)
-
-    # 3. Step 1: Keywords
-    print(f"\n--- Running Step 1: Keywords ({len(step0_data)} items) ---")
-    tasks = [extract_keywords_from_filtered_async(s) for s in step0_data]
-    res1 = await tqdm_asyncio.gather(*tasks)
-    step1_data = [r for r in res1 if r["status"] == "success"]
-    with open(FILE_STEP1, 'w', encoding='utf-8') as f:
-        json.dump(step1_data, f, indent=2, ensure_ascii=False)
-
-    # 4. Step 2: Background Distillation
-    print("\n--- Running Step 2: Distillation ---")
-    tasks = [process_single_sample_background(s) for s in step1_data]
-    res2 = await tqdm_asyncio.gather(*tasks)
-    res2_map = {oid: r.get("distilled_background", "") for oid, r in res2}
-    for item in step1_data:
-        item["distilled_background"] = res2_map.get(
-            item["original_sample_index"], "")
-    with open(FILE_STEP2, 'w', encoding='utf-8') as f:
-        json.dump(step1_data, f, indent=2, ensure_ascii=False)
-
-    # 5. Step 2b: VLM (Images)
-    print("\n--- Running Step 2b: VLM Enhancement ---")
-    source_map = {
-        item["original_sample_index"]: item
-        for item in raw_data
-    }  # Map back to raw for images
-    sem_vlm = asyncio.Semaphore(10)
-    tasks = [process_sample_vlm(s, source_map, sem_vlm) for s in step1_data]
-    res2b = await tqdm_asyncio.gather(*tasks)
-    res2b_map = {oid: caps for oid, caps in res2b}
-    for item in step1_data:
-        item["model-enhanced captions"] = res2b_map.get(
-            item["original_sample_index"], [])
-    with open(FILE_STEP2B, 'w', encoding='utf-8') as f:
-        json.dump(step1_data, f, indent=2, ensure_ascii=False)
-
-    # 6. Step 3.5: Consensus
-    print("\n--- Running Step 3.5: Consensus ---")
-    tasks = [process_sample_consensus(s) for s in step1_data]
-    step3_5_data = await tqdm_asyncio.gather(*tasks)
-    with open(FILE_STEP3_5, 'w', encoding='utf-8') as f:
-        json.dump(step3_5_data, f, indent=2, ensure_ascii=False)
-
-    # 7. Step 3: Context Enhanced
-    print("\n--- Running Step 3: Enhancement ---")
-    tasks = [process_enhanced_caption_gen(s) for s in step3_5_data]
-    step3_data = [
-        r for r in await tqdm_asyncio.gather(*tasks) if r is not None
-    ]
-    with open(FILE_STEP3, 'w', encoding='utf-8') as f:
-        json.dump(step3_data, f, indent=2, ensure_ascii=False)
-
-    # 8. Step 4: Visual QA
-    print("\n--- Running Step 4: Visual QA ---")
-    tasks = [run_visual_qa_task(s) for s in step3_data]
-    step4_data = [
-        r for r in await tqdm_asyncio.gather(*tasks) if r is not None
-    ]
-    with open(FILE_STEP4, 'w', encoding='utf-8') as f:
-        json.dump(step4_data, f, indent=2, ensure_ascii=False)
-
-    # 9. Step 5: Logic Chain
-    print("\n--- Running Step 5: Logic Chain ---")
-    tasks = [run_logic_chain_task(s) for s in step4_data]
-    step5_data = [
-        r for r in await tqdm_asyncio.gather(*tasks) if r is not None
+        def make_fn(stage, fingerprint):
+
+            async def run(item):
+                oid = item.get("original_sample_index")
+                hit, result = store.get(stage.key, oid, fingerprint)
+                if hit:
+                    return result
+                result = await stage.fn(item)
+                if result is not None or stage.cache_drops:
+                    store.put(stage.key, oid, fingerprint, result)
+                return result
+
+            return run
+
+        wrapped.append(stage._replace(fn=make_fn(stage, fingerprint)))
+    return wrapped
+
+
+async def run_stage_item(stage, item):
+    try:
+        return await stage.fn(item)
+    except Exception as e:
+        print(f"Stage Error ({stage.name}): {e}")
+        return None
+
+
+def open_stage_writers(stages):
+    return [JsonlWriter(jsonl_path(stage.out_file)) for stage in stages]
+
+
+def close_stage_writers(stages, writers):
+    for stage, writer in zip(stages, writers):
+        writer.close()
+        if STAGE_JSON_EXPORT:
+            writer.export_json(stage.out_file)
+
+
+async def run_pipeline_barrier(raw_data, stages, order):
+    # Every sample finishes a stage before any sample starts the next one.
+    # Results are appended to the stage's JSONL as they complete, and the
+    # next stage reads its input back from that file, so only the samples in
+    # flight are held in memory.
+    writers = open_stage_writers(stages)
+    data, total = iter(raw_data), len(order)
+    try:
+        for stage, writer in zip(stages, writers):
+            print(f"\n--- Running {stage.name} ({total} items) ---")
+            bar = tqdm(total=total, desc=stage.name)
+
+            async def worker(stage=stage, writer=writer, bar=bar):
+                for item in data:
+                    out = await run_stage_item(stage, item)
+                    bar.update(1)
+                    if out is not None:
+                        writer.write(
+                            out, order.get(out.get("original_sample_index"),
+                                           len(order)))
+
+            await asyncio.gather(
+                *[worker() for _ in range(BARRIER_STAGE_WORKERS)])
+            bar.close()
+            writer.close()
+            data, total = iter_jsonl(writer.path), len(writer)
+    finally:
+        close_stage_writers(stages, writers)
+    return len(writers[-1])
+
+
+async def run_pipeline_streaming(raw_data, stages, order):
+    # Each sample flows through the stages on its own. Stages are connected by
+    # bounded queues, so a straggler only holds up its own sample and the
+    # endpoints of every stage stay busy.
+    queues = [
+        asyncio.Queue(maxsize=STREAM_QUEUE_SIZE) for _ in range(len(stages))
     ]
-    with open(FILE_STEP5, 'w', encoding='utf-8') as f:
-        json.dump(step5_data, f, indent=2, ensure_ascii=False)
-
-    # 10. Step 6: Final Logic QA
-    print("\n--- Running Step 6: Final Logic QA ---")
-    tasks = [run_logic_based_qa_task(s) for s in step5_data]
-    step6_data = [
-        r for r in await tqdm_asyncio.gather(*tasks) if r is not None
+    writers = open_stage_writers(stages)
+    bars = [
+        tqdm(total=len(order), desc=stage.name, position=i, leave=True)
+        for i, stage in enumerate(stages)
     ]
 
-    with open(FINAL_OUTPUT, 'w', encoding='utf-8') as f:
-        json.dump(step6_data, f, indent=2, ensure_ascii=False)
+    async def worker(i):
+        while True:
+            item = await queues[i].get()
+            if item is None:
+                queues[i].task_done()
+                return
+            out = await run_stage_item(stages[i], item)
+            bars[i].update(1)
+            if out is not None:
+                # Serialised right away, before later stages add their keys
+                # to the same dict.
+                writers[i].write(
+                    out, order.get(out.get("original_sample_index"),
+                                   len(order)))
+                if i + 1 < len(stages):
+                    await queues[i + 1].put(out)
+            queues[i].task_done()
+
+    async def feed():
+        for item in raw_data:
+            await queues[0].put(item)
 
-    print(f"\n[DONE] Pipeline complete. Final output saved to {FINAL_OUTPUT}")
-    print(f"Total samples processed successfully: {len(step6_data)}")
+    try:
+        workers = [[
+            asyncio.create_task(worker(i))
+            for _ in range(STREAM_STAGE_WORKERS)
+        ] for i in range(len(stages))]
+        await feed()
+        # Drain stage by stage: once stage i is empty and its workers have
+        # stopped, nothing else can reach stage i + 1.
+        for i in range(len(stages)):
+            await queues[i].join()
+            for _ in workers[i]:
+                await queues[i].put(None)
+            await asyncio.gather(*workers[i])
+    finally:
+        for bar in bars:
+            bar.close()
+        close_stage_writers(stages, writers)
+    return len(writers[-1])
+
+
+# ================= MAIN EXECUTION =================
+
+
+async def main():
+    if not os.path.exists(INPUT_SOURCE_FILE):
+        print(f"Error: {INPUT_SOURCE_FILE} not found.")
+        return
+    # Samples are parsed lazily from disk; Step 2b looks images up by
+    # original_sample_index through the corpus' offset index.
+    corpus = Corpus(INPUT_SOURCE_FILE)
+    if SHARD:
+        corpus.restrict(lambda oid: shard_of(oid, SHARD[1]) == SHARD[0])
+        print(f"Shard {SHARD[0]}/{SHARD[1]}")
+    print(f"Loaded {len(corpus)} items.")
+    # Input position of every sample; stage outputs are exported in it.
+    order = corpus.positions()
+    text_batchers = build_text_batchers()
+    stages = build_pipeline_stages(corpus, text_batchers)
+    run_start = time.monotonic()
+    store = None
+    if CHECKPOINT_FILE:
+        store = CheckpointStore(CHECKPOINT_FILE)
+        print(f"Checkpoint store: {CHECKPOINT_FILE} "
+              f"({len(store.records)} records)")
+        stages = with_checkpoints(stages, store)
+
+    try:
+        if PIPELINE_MODE == "streaming":
+            print(f"\n--- Running {len(stages)} stages in streaming mode ---")
+            num_final = await run_pipeline_streaming(corpus, stages, order)
+        else:
+            num_final = await run_pipeline_barrier(corpus, stages, order)
+    finally:
+        corpus.close()
+        if store is not None:
+            store.close()
+            print(f"Checkpoint reuse: {store.hits} hits, "
+                  f"{store.misses} misses")
+        if prefilter is not None:
+            print(f"Step 0 prefilter: {prefilter.stats()}")
+        if step0_labels is not None:
+            step0_labels.close()
+        if response_cache is not None:
+            print(f"Response cache: {response_cache.stats()}")
+        for limiter in (text_limiter, vl_limiter):
+            print(f"Endpoint limiter: {limiter.stats()}")
+        print(f"Retries: {retry_policy.stats()}")
+        for name, batcher in zip(("filter", "keywords"), text_batchers):
+            if batcher is not None:
+                print(f"Text batching [{name}]: {batcher.stats()}")
+        if vl_image_cache is not None:
+            print(f"VL image cache: {vl_image_cache.stats()}")
+        if qc_stats:
+            print(f"Step 7 QC: {qc_stats}")
+        for stage, counts in parse_stats.report().items():
+            print(f"Parse [{stage}]: {counts}")
+        elapsed = time.monotonic() - run_start
+        for model, totals in usage_totals.items():
+            tokens = totals["prompt_tokens"] + totals["completion_tokens"]
+            print(f"Usage [{model}]: {totals['requests']} requests, "
+                  f"{totals['prompt_tokens']} prompt + "
+                  f"{totals['completion_tokens']} completion tokens, "
+                  f"avg latency "
+                  f"{totals['latency'] / max(totals['requests'], 1):.2f}s, "
+                  f"{tokens / max(elapsed, 1e-9):.1f} tokens/s")
+
+    final_output = stages[-1].out_file
+    print(f"\n[DONE] Pipeline complete. Final output saved to "
+          f"{jsonl_path(final_output)}" +
+          (f" and {final_output}" if STAGE_JSON_EXPORT else ""))
+    if RUN_QC:
+        print(f"Only QA pairs that passed Step 7 QC are in it; all QA pairs "
+              f"before QC are in {jsonl_path(stages[-2].out_file)}")
+    print(f"Total samples processed successfully: {num_final}")
+
+
+def configure_shard(shard):
+    # Per-shard files and endpoint budgets; must run before main().
+    global SHARD, CHECKPOINT_FILE, text_limiter, vl_limiter, step0_labels
+    SHARD = shard
+    CHECKPOINT_FILE = shard_path(CHECKPOINT_FILE, shard)
+    if step0_labels is not None:
+        step0_labels.close()
+        step0_labels = LabelLog(shard_path(PREFILTER_LABELS_FILE, shard))
+    text_limiter = EndpointLimiter("text",
+                                   overload_errors=RETRYABLE_ERRORS,
+                                   **endpoint_limits(TEXT_ENDPOINT_LIMITS))
+    vl_limiter = EndpointLimiter("vl",
+                                 overload_errors=RETRYABLE_ERRORS,
+                                 **endpoint_limits(VL_ENDPOINT_LIMITS))
+
+
+def merge_shards(count):
+    # Combine the per-shard outputs of every step, in input order.
+    corpus = Corpus(INPUT_SOURCE_FILE)
+    order = corpus.positions()
+    corpus.close()
+    for stage in build_pipeline_stages(None):
+        paths = [
+            jsonl_path(shard_path(stage.out_file, (i, count)))
+            for i in range(count)
+        ]
+        writer = merge_jsonl(paths, jsonl_path(stage.out_file), order)
+        if STAGE_JSON_EXPORT:
+            writer.export_json(stage.out_file)
+        print(f"{stage.name}: merged {len(writer)} samples from {count} "
+              f"shards into {jsonl_path(stage.out_file)}")
+
+
+def launch_shards(count):
+    # Runs `--shard i/N` for every i as local processes (one event loop and
+    # core each), then merges their outputs. On several nodes, start the
+    # shards there instead and run `--merge N` once all have finished.
+    Corpus(INPUT_SOURCE_FILE).close()  # build the offset index only once
+    procs = []
+    for i in range(count):
+        log_path = shard_path("qa_generation.log", (i, count))
+        log = open(log_path, 'w', encoding='utf-8')
+        print(f"Shard {i}/{count}: logging to {log_path}")
+        procs.append((log,
+                      subprocess.Popen([
+                          sys.executable,
+                          os.path.abspath(__file__), "--shard",
+                          f"{i}/{count}"
+                      ],
+                                       stdout=log,
+                                       stderr=subprocess.STDOUT)))
+    failed = []
+    for i, (log, proc) in enumerate(procs):
+        proc.wait()
+        log.close()
+        if proc.returncode:
+            failed.append(i)
+    if failed:
+        print(f"Shards {failed} failed; fix and re-run them with --shard "
+              f"i/{count} (checkpoints are kept), then --merge {count}.")
+        return 1
+    merge_shards(count)
+    return 0
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(
+        description="Run the QA generation pipeline.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--shard",
+                      type=parse_shard,
+                      help="run only shard i of N, e.g. 0/4")
+    mode.add_argument("--launch",
+                      type=int,
+                      metavar="N",
+                      help="run N shards as local processes, then merge")
+    mode.add_argument("--merge",
+                      type=int,
+                      metavar="N",
+                      help="merge the outputs of N finished shards")
+    args = parser.parse_args()
+
+    if args.launch:
+        sys.exit(launch_shards(args.launch))
+    elif args.merge:
+        merge_shards(args.merge)
+    else:
+        if args.shard:
+            configure_shard(args.shard)
+        asyncio.run(main())
@@ -0,0 +1,217 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+
+# Per-endpoint request limiting: token buckets for requests/s and tokens/s,
+# plus an AIMD concurrency window that grows while the endpoint answers
+# quickly and is halved on overload errors or when latency exceeds the target.
+# Retries are governed by RetryPolicy (jittered backoff and a per-run budget).
+
+# Always treated as overload, on top of a limiter's `overload_errors`.
+OVERLOAD_ERRORS = (TimeoutError, asyncio.TimeoutError, ConnectionError)
+
+
+def is_overload(error, overload_errors=()):
+    # 429, 5xx, timeouts and connection errors mean the endpoint is
+    # overloaded; client errors (400, context length, local bugs) do not.
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return isinstance(error, OVERLOAD_ERRORS + tuple(overload_errors))
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1.0):
+        # Requests larger than the bucket only wait for a full bucket.
+        amount = min(float(amount), self.capacity)
+        if self._lock is None:
+            # Created lazily so limiters can be built at import time and
+            # still bind to the loop started by asyncio.run (Python 3.9).
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def debit(self, amount):
+        # Charge usage that was only known after the response; the bucket may
+        # go negative, which delays the following requests.
+        self._refill()
+        self.tokens -= float(amount)
+
+
+class _RequestHandle:
+
+    def __init__(self, estimated_tokens):
+        self.estimated_tokens = estimated_tokens
+        # Set to the real token usage once the response is known.
+        self.tokens = None
+
+
+class EndpointLimiter:
+
+    def __init__(self,
+                 name,
+                 max_concurrency=64,
+                 min_concurrency=1,
+                 initial_concurrency=None,
+                 requests_per_second=None,
+                 tokens_per_second=None,
+                 target_latency=None,
+                 decrease_factor=0.5,
+                 overload_errors=()):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        # Client exception types (e.g. connection errors) that count as
+        # overload besides the ones is_overload knows.
+        self.overload_errors = tuple(overload_errors)
+        self.request_bucket = TokenBucket(
+            requests_per_second) if requests_per_second else None
+        self.token_bucket = TokenBucket(
+            tokens_per_second) if tokens_per_second else None
+        self.in_flight = 0
+        self.successes = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self._last_decrease = 0.0
+        self._cond = None
+
+    @asynccontextmanager
+    async def request(self, estimated_tokens=0):
+        handle = _RequestHandle(estimated_tokens)
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket is not None and estimated_tokens:
+            await self.token_bucket.acquire(estimated_tokens)
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield handle
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_overload(e, self.overload_errors):
+                self._on_error()
+            raise
+        else:
+            self._on_success(time.monotonic() - start)
+        finally:
+            if self.token_bucket is not None and handle.tokens is not None:
+                self.token_bucket.debit(handle.tokens - estimated_tokens)
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def _on_success(self, latency):
+        self.successes += 1
+        self.total_latency += latency
+        if self.target_latency and latency > self.target_latency:
+            self._decrease()
+        else:
+            # Additive increase: about +1 per window of successful requests.
+            self.limit = min(float(self.max_concurrency),
+                             self.limit + 1.0 / max(self.limit, 1.0))
+
+    def _on_error(self):
+        self.errors += 1
+        self._decrease()
+
+    def _decrease(self):
+        # A burst of failures from one congested window only counts once.
+        now = time.monotonic()
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_concurrency),
+                         self.limit * self.decrease_factor)
+
+    def stats(self):
+        return {
+            "endpoint": self.name,
+            "concurrency_limit": int(self.limit),
+            "successes": self.successes,
+            "errors": self.errors,
+            "avg_latency": self.total_latency / self.successes
+            if self.successes else 0.0
+        }
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter, an optional server-provided
+    # Retry-After floor, and a per-run retry budget: every request deposits
+    # `budget_ratio` retry tokens (on top of `budget_min`), so under a broad
+    # outage retries stay a bounded fraction of the traffic instead of
+    # multiplying it.
+
+    def __init__(self,
+                 base_delay=1.0,
+                 max_delay=60.0,
+                 budget_ratio=0.2,
+                 budget_min=50):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget = float(budget_min)
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.errors = {}
+
+    def on_request(self):
+        self.budget += self.budget_ratio
+
+    def record_error(self, error):
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def allow_retry(self):
+        if self.budget < 1.0:
+            self.budget_exhausted += 1
+            return False
+        self.budget -= 1.0
+        self.retries += 1
+        return True
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay,
+                                      self.base_delay * 2**attempt))
+        if retry_after is not None:
+            # Wait at least as long as the server asked, plus jitter so the
+            # waiting tasks do not come back in lockstep.
+            delay = min(self.max_delay, retry_after) + random.uniform(
+                0, self.base_delay)
+        return delay
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "budget_left": int(self.budget),
+            "budget_exhausted": self.budget_exhausted,
+            "errors": dict(self.errors)
+        }
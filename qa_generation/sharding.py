@@ -0,0 +1,74 @@
+import json
+import os
+import zlib
+
+from jsonl_io import JsonlWriter
+
+# Deterministic partitioning of the corpus for running one dataset in several
+# processes or on several nodes. A sample belongs to shard
+# crc32(original_sample_index) % N, so every process agrees on the split
+# without talking to the others. Each shard writes its own files
+# (`step0_filtered.shard-0-of-4.jsonl`, ...), which are merged back in input
+# order afterwards.
+
+
+def parse_shard(spec):
+    index, count = (int(x) for x in spec.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(
+            f"invalid shard {spec!r}, expected i/N with 0 <= i < N")
+    return index, count
+
+
+def shard_of(oid, count):
+    return zlib.crc32(str(oid).encode("utf-8")) % count
+
+
+def shard_path(path, shard):
+    if not path or shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def scale_limits(limits, count):
+    # Shards share the endpoints, so each one gets 1/count of the budget.
+    scaled = dict(limits)
+    for key in ("max_concurrency", "initial_concurrency"):
+        if scaled.get(key):
+            scaled[key] = max(1, scaled[key] // count)
+    if scaled.get("min_concurrency"):
+        scaled["min_concurrency"] = min(scaled["min_concurrency"],
+                                        scaled.get("max_concurrency", 1))
+    for key in ("requests_per_second", "tokens_per_second"):
+        if scaled.get(key):
+            scaled[key] = scaled[key] / count
+    return scaled
+
+
+def merge_jsonl(paths, out_path, order):
+    # Combine the per-shard JSONL files into one file in input order. Only
+    # (position, shard, offset) triples are held in memory.
+    entries = []
+    for n, path in enumerate(paths):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"missing shard output {path}")
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    oid = json.loads(line).get("original_sample_index")
+                    entries.append((order.get(oid, len(order)), n, offset))
+                offset += len(line)
+    entries.sort()
+    writer = JsonlWriter(out_path)
+    files = [open(path, 'rb') for path in paths]
+    try:
+        for position, n, offset in entries:
+            files[n].seek(offset)
+            writer.write_line(files[n].readline(), position)
+    finally:
+        for f in files:
+            f.close()
+        writer.close()
+    return writer
@@ -0,0 +1,283 @@
+import json
+import re
+
+# Shared parsing of the JSON answers of every stage. Answers are accepted
+# with or without ```json fences and with a chatty preamble or epilogue;
+# trailing commas and answers cut off by max_tokens are repaired locally.
+# The result is checked against a small JSON-Schema subset (type,
+# properties, additionalProperties, required, items, minItems, enum) so a stage either gets data of
+# the shape it expects or a ParseError describing what is wrong, which is
+# what the repair re-prompt sends back to the model.
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_DECODER = json.JSONDecoder()
+_OPENERS = {"object": "{", "array": "["}
+
+
+class ParseError(ValueError):
+    pass
+
+
+def _locate(text, expected=None):
+    # (text, start, value) of the JSON value inside a model answer, searched
+    # in the fenced block if there is one. Candidates are the brackets that
+    # can open a value of an `expected` type, left to right:
+    # - a value that decodes is the answer;
+    # - one still open when the text ends was cut off by max_tokens, and is
+    #   returned with value None for _close_truncated (never an inner value
+    #   of it that happens to decode);
+    # - one that closes but only decodes without its trailing commas is
+    #   returned the same way;
+    # - one that closes but is not JSON (e.g. "[Image 1]" in a preamble) is
+    #   skipped together with everything inside it.
+    text = text.strip()
+    match = _FENCE_RE.search(text)
+    if match and match.group(1).strip():
+        text = match.group(1).strip()
+    starts = [i for i, c in enumerate(text) if c in "{["]
+    if not starts:
+        raise ParseError("no JSON object or array in the answer")
+    if isinstance(expected, str):
+        expected = [expected]
+    openers = "".join(_OPENERS[t] for t in expected or () if t in _OPENERS)
+    openers = openers or "{["
+    skip_until = 0
+    for i in starts:
+        if i < skip_until or text[i] not in openers:
+            continue
+        try:
+            return text, i, _DECODER.raw_decode(text, i)[0]
+        except json.JSONDecodeError:
+            pass
+        end = _scan(text[i:])[0]
+        if end is None:
+            return text, i, None
+        try:
+            json.loads(_strip_trailing_commas(text[i:i + end]))
+            return text, i, None
+        except json.JSONDecodeError:
+            skip_until = i + end
+    start = next((i for i in starts if text[i] in openers), starts[0])
+    return text, start, None
+
+
+def extract_json_text(text, expected=None):
+    # The answer from the start of its JSON value on; `expected` is a schema
+    # type ("object", "array" or a list of them).
+    text, start, _ = _locate(text, expected)
+    return text[start:]
+
+
+def _scan(text):
+    # Returns (end of the first complete value or None, stack of unclosed
+    # brackets, whether the text ends inside a string, positions of the
+    # commas outside strings).
+    stack = []
+    commas = []
+    in_string = False
+    escaped = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == ",":
+            commas.append(i)
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, [], False, commas
+    return None, stack, in_string, commas
+
+
+def _strip_trailing_commas(text):
+    # Only outside strings: split on string literals first.
+    parts = re.split(r'("(?:\\.|[^"\\])*")', text)
+    return "".join(p if i % 2 else _TRAILING_COMMA_RE.sub(r"\1", p)
+                   for i, p in enumerate(parts))
+
+
+def _close_truncated(text):
+    # An answer cut off by max_tokens: close the open string and brackets.
+    # If the last element was cut mid-way (e.g. a key without its value),
+    # drop it by cutting back to the previous comma and try again.
+    for _ in range(32):
+        _, stack, in_string, commas = _scan(text)
+        candidate = text + '"' if in_string else text
+        candidate = re.sub(r"[\s,:]*$", "", candidate)
+        try:
+            return json.loads(
+                _strip_trailing_commas(candidate + "".join(reversed(stack))))
+        except json.JSONDecodeError:
+            if not commas:
+                break
+            text = text[:commas[-1]]
+    raise ParseError("truncated JSON could not be repaired")
+
+
+def parse_json(text, expected=None):
+    # Returns (value, repaired); raises ParseError.
+    text, start, value = _locate(text, expected)
+    if value is not None:
+        # Well-formed JSON, possibly between prose.
+        return value, False
+    candidate = text[start:]
+    end, _, _, _ = _scan(candidate)
+    if end is None:
+        return _close_truncated(candidate), True
+    candidate = candidate[:end]
+    try:
+        return json.loads(candidate), False
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(_strip_trailing_commas(candidate)), True
+    except json.JSONDecodeError as e:
+        raise ParseError(f"invalid JSON: {e}") from None
+
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "integer": int,
+    "number": (int, float),
+    "null": type(None)
+}
+
+
+def validate(value, schema, path="$"):
+    # Raises ParseError for the first mismatch.
+    if not schema:
+        return
+    expected = schema.get("type")
+    if expected:
+        types = expected if isinstance(expected, list) else [expected]
+        ok = any(
+            isinstance(value, _TYPES[t]) and not (
+                t in ("integer", "number") and isinstance(value, bool))
+            for t in types)
+        if not ok:
+            raise ParseError(f"{path} should be {' or '.join(types)}, got "
+                             f"{type(value).__name__}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise ParseError(f"{path} should be one of {schema['enum']}")
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                raise ParseError(f"{path} is missing '{key}'")
+        properties = schema.get("properties", {})
+        for key, sub in properties.items():
+            if key in value:
+                validate(value[key], sub, f"{path}.{key}")
+        extra = schema.get("additionalProperties")
+        if isinstance(extra, dict):
+            for key in value.keys() - properties.keys():
+                validate(value[key], extra, f"{path}.{key}")
+    elif isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            raise ParseError(
+                f"{path} needs at least {schema['minItems']} item(s)")
+        for i, item in enumerate(value):
+            validate(item, schema.get("items"), f"{path}[{i}]")
+
+
+def parse_structured(text, schema=None):
+    # Returns (value, repaired); raises ParseError.
+    value, repaired = parse_json(text, (schema or {}).get("type"))
+    validate(value, schema)
+    return value, repaired
+
+
+class ParseStats:
+
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage, outcome):
+        # outcome: "ok", "repaired", "reprompted" or "failed".
+        counts = self.stages.setdefault(stage, {
+            "ok": 0,
+            "repaired": 0,
+            "reprompted": 0,
+            "failed": 0
+        })
+        counts[outcome] += 1
+
+    def report(self):
+        out = {}
+        for stage, counts in self.stages.items():
+            total = sum(counts.values())
+            out[stage] = dict(counts,
+                              failure_rate=counts["failed"] / total,
+                              first_try_failure_rate=(counts["reprompted"] +
+                                                      counts["failed"]) /
+                              total)
+        return out
+
+
+# Regression cases, checked by running this file: (answer, schema, value).
+_CAPTIONS_SCHEMA = {
+    "type": "object",
+    "required": ["Context_Enhanced_Captions"],
+    "properties": {
+        "Context_Enhanced_Captions": {
+            "type": "object"
+        }
+    }
+}
+_CONTEXTS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "required": ["research_context"]
+    }
+}
+SELF_CHECKS = [
+    ('Here is the answer for [Image 1]: {"a": [1, 2]}', {
+        "type": "object"
+    }, {
+        "a": [1, 2]
+    }),
+    ('For [Image 1]: {"a": 1,} thanks', {
+        "type": "object"
+    }, {
+        "a": 1
+    }),
+    # Truncated nested object: repaired, not answered with the inner value.
+    ('```json\n{"Context_Enhanced_Captions": {"Image 1": {"caption": "A '
+     'stained section", "summary": "cut', _CAPTIONS_SCHEMA, {
+         "Context_Enhanced_Captions": {
+             "Image 1": {
+                 "caption": "A stained section",
+                 "summary": "cut"
+             }
+         }
+     }),
+    # Truncated array of objects.
+    ('[{"research_context": "x", "qa": {"q": "a"}}, {"research_context": '
+     '"y", "qa": {"q"', _CONTEXTS_SCHEMA, [{
+         "research_context": "x",
+         "qa": {
+             "q": "a"
+         }
+     }, {
+         "research_context": "y"
+     }]),
+]
+
+if __name__ == "__main__":
+    for answer, schema, expected in SELF_CHECKS:
+        value, _ = parse_structured(answer, schema)
+        assert value == expected, (answer, value)
+    print(f"{len(SELF_CHECKS)} parse checks passed")